@@ -0,0 +1,313 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - This is the async counterpart of storage.py, used by the async serving mode
+#   (see task_tracker_asgi.py). Methods are the same, except they're coroutines.
+# - The Firestore engine uses the asyncio Firestore client directly (Fireo does
+#   not support it) but reads and writes documents in the same format; the
+#   writes of its transactions are shared with the sync engine (see
+#   transactions.py).
+# - The memory engine shares its data with the sync one, so endpoints that are
+#   not implemented as coroutines (and run in threads) see the same data.
+import asyncio
+from google.api_core.exceptions import NotFound
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from stats import STATS_SHARD_COUNT, shard_reference, sum_counters
+from storage import DEFAULT_PAGE_SIZE, FIRESTORE_BATCH_SIZE
+from storage import DelayedStorage, LazyStorage, MemoryStorage
+from storage import UserNotFound, username_to_id, lookup_to_user
+from storage import snapshot_to_task, snapshot_to_task_version, version_to_time
+from transactions import create_user_writes, create_tasks_writes, update_tasks_writes
+from transactions import mark_tasks_writes, delete_tasks_writes
+from metrics import InstrumentedStorage, AsyncInstrumentedStorage
+
+async def list_document_ids(collection, limit, cursor, filters={}):
+    query = collection.select([])
+    for field, value in filters.items():
+        query = query.where(field, '==', value)
+
+    query = query.order_by(FieldPath.document_id())
+
+    if cursor:
+        query = query.start_after({FieldPath.document_id(): cursor})
+
+    if not limit:
+        limit = DEFAULT_PAGE_SIZE
+
+    return [snapshot.id async for snapshot in query.limit(limit).stream()]
+
+@firestore.async_transactional
+async def create_user_transaction(transaction, client, username, password):
+    lookup = client.collection("usernames").document(username_to_id(username))
+
+    snapshot = await lookup.get(transaction=transaction)
+    if snapshot.exists:
+        return lookup_to_user(snapshot), False
+
+    query = client.collection("users").where('username', '==', username).select(['password', 'last_updated'])
+    legacy_snapshots = [snapshot async for snapshot in query.stream(transaction=transaction)]
+
+    return create_user_writes(transaction, client, lookup, legacy_snapshots, username, password)
+
+@firestore.async_transactional
+async def create_tasks_transaction(transaction, client, user_key, tasks, max_task_count):
+    user_reference = client.document(user_key)
+    snapshot = await user_reference.get(field_paths=['task_count'], transaction=transaction)
+
+    return create_tasks_writes(transaction, client, snapshot, tasks, max_task_count)
+
+@firestore.async_transactional
+async def mark_tasks_transaction(transaction, client, user_key, references, status):
+    task_snapshots = [snapshot async for snapshot in transaction.get_all(references)]
+    mark_tasks_writes(transaction, client.document(user_key), task_snapshots, status)
+
+@firestore.async_transactional
+async def delete_tasks_transaction(transaction, client, user_key, references):
+    deleted_ids = {snapshot.id async for snapshot in transaction.get_all(references) if snapshot.exists}
+    if not deleted_ids:
+        return deleted_ids
+
+    delete_tasks_writes(transaction, client, client.document(user_key), deleted_ids)
+    return deleted_ids
+
+class AsyncFirestoreStorage:
+    def __init__(self):
+        self._client = None
+        self._watch_client = None
+
+    @property
+    def client(self):
+        # The client is created on first use, from within the event loop.
+        if self._client is None:
+            self._client = firestore.AsyncClient()
+        return self._client
+
+    @property
+    def watch_client(self):
+        # The async client can't listen to documents; a sync client is
+        # created for it (its listeners run in background threads).
+        if self._watch_client is None:
+            self._watch_client = firestore.Client()
+        return self._watch_client
+
+    async def get_or_create_user(self, username, password):
+        lookup = self.client.collection("usernames").document(username_to_id(username))
+
+        snapshot = await lookup.get()
+        if snapshot.exists:
+            return lookup_to_user(snapshot), False
+
+        return await create_user_transaction(self.client.transaction(), self.client, username, password)
+
+    async def get_user(self, user_id):
+        snapshot = await self.client.collection("users").document(user_id).get()
+        if not snapshot.exists:
+            return None
+
+        values = snapshot.to_dict()
+        return {
+            'key':          'users/' + user_id,
+            'username':     values['username'],
+            'password':     values['password'],
+            'last_updated': values['last_updated'],
+            'task_count':   values.get('task_count', 0)
+        }
+
+    async def list_user_ids(self, limit, cursor):
+        return await list_document_ids(self.client.collection("users"), limit, cursor)
+
+    async def create_task(self, user_key, name, description, status, max_task_count):
+        task = {
+            'name':        name,
+            'description': description,
+            'status':      status
+        }
+
+        task_ids = await self.create_tasks(user_key, [task], max_task_count)
+        if task_ids is None:
+            return None
+
+        return task_ids[0]
+
+    async def create_tasks(self, user_key, tasks, max_task_count):
+        transaction = self.client.transaction()
+        return await create_tasks_transaction(transaction, self.client, user_key, tasks, max_task_count)
+
+    async def get_task(self, user_key, task_id):
+        snapshot = await self.client.document(user_key + '/tasks/' + task_id).get()
+        if not snapshot.exists:
+            return None
+
+        return snapshot_to_task(snapshot)
+
+    async def get_tasks(self, user_key, task_ids):
+        references = [self.client.document(user_key + '/tasks/' + task_id) for task_id in set(task_ids)]
+
+        tasks = {}
+        async for snapshot in self.client.get_all(references):
+            if snapshot.exists:
+                tasks[snapshot.id] = snapshot_to_task(snapshot)
+
+        return tasks
+
+    async def update_task(self, user_key, task_id, fields):
+        task_reference = self.client.document(user_key + '/tasks/' + task_id)
+
+        if not fields:
+            snapshot = await task_reference.get(field_paths=[])
+            return snapshot.exists
+
+        user_reference = self.client.document(user_key)
+
+        batch = self.client.batch()
+        update_tasks_writes(batch, user_reference, [task_reference], fields)
+
+        try:
+            await batch.commit()
+        except NotFound:
+            snapshot = await user_reference.get(field_paths=[])
+            if not snapshot.exists:
+                raise UserNotFound(user_key)
+            return False
+
+        return True
+
+    async def delete_task(self, user_key, task_id):
+        return len(await self.delete_tasks(user_key, [task_id])) > 0
+
+    async def delete_tasks(self, user_key, task_ids):
+        references = [self.client.document(user_key + '/tasks/' + task_id) for task_id in set(task_ids)]
+        if not references:
+            return set()
+
+        try:
+            transaction = self.client.transaction()
+            return await delete_tasks_transaction(transaction, self.client, user_key, references)
+        except NotFound:
+            raise UserNotFound(user_key)
+
+    async def list_task_ids(self, user_key, limit, cursor, status=None):
+        tasks = self.client.document(user_key).collection("tasks")
+        return await list_document_ids(tasks, limit, cursor, {'status': status} if status else {})
+
+    async def count_tasks(self, user_key, statuses):
+        tasks = self.client.document(user_key).collection("tasks")
+
+        # The aggregation queries are executed concurrently.
+        queries = [tasks.where('status', '==', status).count().get() for status in statuses]
+        results = await asyncio.gather(*queries)
+
+        return {status: result[0][0].value for status, result in zip(statuses, results)}
+
+    async def mark_all_tasks_as(self, user_key, status):
+        user_reference = self.client.document(user_key)
+        query = user_reference.collection("tasks").where('status', '!=', status).select([])
+
+        async def commit(references):
+            try:
+                transaction = self.client.transaction()
+                await mark_tasks_transaction(transaction, self.client, user_key, references, status)
+            except NotFound:
+                raise UserNotFound(user_key)
+
+        references = []
+        async for task_snapshot in query.stream():
+            references.append(task_snapshot.reference)
+
+            if len(references) == FIRESTORE_BATCH_SIZE - 1:
+                await commit(references)
+                references = []
+
+        if references:
+            await commit(references)
+
+    async def get_task_version(self, user_key):
+        snapshot = await self.client.document(user_key).get(field_paths=['task_version'])
+        return snapshot_to_task_version(snapshot)
+
+    async def list_task_changes(self, user_key, version):
+        user_reference = self.client.document(user_key)
+
+        if version == 0:
+            tasks = user_reference.collection("tasks").stream()
+            return {snapshot.id: snapshot_to_task(snapshot) async for snapshot in tasks}, []
+
+        tasks = user_reference.collection("tasks").where('version', '>', version_to_time(version))
+        deleted_tasks = user_reference.collection("deleted_tasks").where('version', '>', version_to_time(version)).select([])
+
+        async def read_changed_tasks():
+            return {snapshot.id: snapshot_to_task(snapshot) async for snapshot in tasks.stream()}
+
+        async def read_deleted_ids():
+            return [snapshot.id async for snapshot in deleted_tasks.stream()]
+
+        changed_tasks, deleted_ids = await asyncio.gather(read_changed_tasks(), read_deleted_ids())
+        return changed_tasks, deleted_ids
+
+    async def watch_task_version(self, user_key, callback):
+        def on_snapshot(snapshots, changes, read_time):
+            for snapshot in snapshots:
+                callback(snapshot_to_task_version(snapshot))
+
+        # Creating the listener opens a stream; it's done in a thread.
+        user_reference = self.watch_client.document(user_key)
+        watch = await asyncio.to_thread(user_reference.on_snapshot, on_snapshot)
+
+        return watch.unsubscribe
+
+    async def read_counters(self):
+        shards = [shard_reference(index, self.client) for index in range(STATS_SHARD_COUNT)]
+        return sum_counters([snapshot async for snapshot in self.client.get_all(shards)])
+
+class AsyncMemoryStorage:
+    """ Expose the methods of the (sync) memory engine as coroutines.
+
+    The memory engine never blocks for long (it only takes a lock for the
+    duration of a dict operation) so its methods are called directly.
+    """
+
+    def __init__(self, storage, latency=0.0):
+        self.storage = storage
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def coroutine(*args):
+            if self.latency > 0:
+                await asyncio.sleep(self.latency)
+            return method(*args)
+
+        return coroutine
+
+def make_async_storage(storage):
+    """ Make the async counterpart of a (sync) storage engine. """
+
+    instrumented = isinstance(storage, InstrumentedStorage)
+    if instrumented:
+        storage = storage.storage
+
+    latency = 0.0
+    if isinstance(storage, DelayedStorage):
+        storage, latency = storage.storage, storage.latency
+
+    if isinstance(storage, LazyStorage):
+        storage = storage.load()
+
+    if isinstance(storage, MemoryStorage):
+        async_storage = AsyncMemoryStorage(storage, latency)
+    else:
+        # The simulated latency is meant for the memory engine only.
+        async_storage = AsyncFirestoreStorage()
+
+    if instrumented:
+        async_storage = AsyncInstrumentedStorage(async_storage)
+
+    return async_storage
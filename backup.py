@@ -0,0 +1,110 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Back up the whole database to a NDJSON file, or restore it from one (see
+# ndjson.py for the format; each user is followed by its tasks). Documents are
+# streamed in both directions so the memory use doesn't depend on the size of
+# the database.
+#
+# Restored documents keep their IDs (existing documents are overwritten) and
+# are written in batches; the counters are rebuilt once all documents are
+# written (see stats.py).
+import time
+import argparse
+import fireo
+from fireo import db
+from google.cloud.firestore_v1.field_path import FieldPath
+from ndjson import dump_record, load_record, read_lines
+from ndjson import user_record, task_record, record_to_user, record_to_task
+from stats import reconcile
+from storage import FIRESTORE_BATCH_SIZE, snapshot_to_task
+from firestore_storage import username_reference
+
+READ_CHUNK_SIZE = 65536
+
+def back_up(file):
+    user_count = 0
+    task_count = 0
+
+    users = db.conn.collection("users").order_by(FieldPath.document_id())
+    for user_snapshot in users.stream():
+        file.write(dump_record(user_record(user_snapshot.id, user_snapshot.to_dict())))
+        user_count += 1
+
+        tasks = user_snapshot.reference.collection("tasks").order_by(FieldPath.document_id())
+        for task_snapshot in tasks.stream():
+            file.write(dump_record(task_record(task_snapshot.id, snapshot_to_task(task_snapshot))))
+            task_count += 1
+
+    return user_count, task_count
+
+def restore(file):
+    user_count = 0
+    task_count = 0
+
+    batch = fireo.batch()
+    batch_size = 0
+
+    user_reference = None
+    chunks = iter(lambda: file.read(READ_CHUNK_SIZE), b'')
+    for line in read_lines(chunks):
+        if not line.strip():
+            continue
+
+        record = load_record(line)
+        if record['type'] == 'user':
+            user = record_to_user(record)
+            user_reference = db.conn.collection("users").document(record['id'])
+
+            batch.set(user_reference, user)
+            batch.set(username_reference(user['username']), {
+                'user_key': 'users/' + record['id'],
+                'password': user['password']
+            })
+            batch_size += 2
+            user_count += 1
+        else:
+            assert user_reference is not None, "task record without user record"
+
+            task_reference = user_reference.collection("tasks").document(record['id'])
+            batch.set(task_reference, record_to_task(record))
+            batch_size += 1
+            task_count += 1
+
+        # Leave room for the two writes of a user.
+        if batch_size >= FIRESTORE_BATCH_SIZE - 1:
+            batch.commit()
+            batch = fireo.batch()
+            batch_size = 0
+
+    if batch_size > 0:
+        batch.commit()
+
+    return user_count, task_count
+
+parser = argparse.ArgumentParser(description="Back up the database to a NDJSON file, or restore it from one.")
+parser.add_argument('command', choices=('back-up', 'restore'))
+parser.add_argument('path', help="path of the NDJSON file")
+arguments = parser.parse_args()
+
+start_time = time.perf_counter()
+
+if arguments.command == 'back-up':
+    with open(arguments.path, 'w') as file:
+        user_count, task_count = back_up(file)
+
+    print(f"{user_count} users and {task_count} tasks backed up")
+else:
+    with open(arguments.path, 'rb') as file:
+        user_count, task_count = restore(file)
+
+    print(f"{user_count} users and {task_count} tasks restored, rebuilding the counters...")
+    reconcile()
+
+elapsed_time = time.perf_counter() - start_time
+print(f"Took {elapsed_time:.2f}s")
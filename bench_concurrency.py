@@ -0,0 +1,89 @@
+import time
+import random
+import string
+import argparse
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+MESSAGE = """\
+Measure the number of requests each serving mode keeps in flight. Start both \
+modes with the memory engine and a simulated database latency, and without \
+the caches (or the coalescing) that would answer requests without reading \
+the database, for instance:
+
+  export STORAGE_ENGINE=memory STORAGE_LATENCY=50 RATE_LIMIT=0 MAX_IN_FLIGHT=0 MAX_QUEUE_TIME=0 COALESCE_WINDOW=0 TASK_CACHE_TTL=0
+  gunicorn --bind :8000 --workers 1 --threads 8 'task_tracker:with_unicorn()'
+  uvicorn --port 8001 task_tracker_asgi:app
+
+then run this script with their URLs (and the same latency). Each request \
+gets a task (a single read of the database).
+"""
+
+REQUEST_COUNT = 2000
+CONCURRENCY_LEVELS = (8, 64, 256)
+
+parser = argparse.ArgumentParser(description=MESSAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('urls', nargs='+', help="base URL of each server")
+parser.add_argument('--latency', type=int, default=50, help="simulated database latency of the servers (in milliseconds)")
+parser.add_argument('--requests', type=int, default=REQUEST_COUNT, help="number of requests per run")
+arguments = parser.parse_args()
+
+def create_task(base_url):
+    """ Log in as a new user and create a task; return the headers and the
+    URL to get the task.
+    """
+
+    username = 'bench_' + ''.join(random.choices(string.ascii_lowercase, k=8))
+    password = 'Password' + ''.join(random.choices(string.digits, k=4))
+
+    response = requests.post(base_url + "/login", json={'username': username, 'password': password})
+    assert response.status_code == 200, response.text
+    headers = {"Authorization": f"Bearer {response.json()}"}
+
+    response = requests.post(base_url + "/tasks/create", json={'name': "Task", 'description': None, 'status': None}, headers=headers)
+    assert response.status_code == 200, response.text
+
+    return headers, base_url + f"/tasks/{response.json()}/get"
+
+def probe_task(session, url, headers):
+    start = time.perf_counter()
+    response = session.post(url, headers=headers)
+    elapsed_time = time.perf_counter() - start
+
+    assert response.status_code == 200, response.text
+    return elapsed_time
+
+def run(base_url, concurrency):
+    headers, url = create_task(base_url)
+
+    # One session per thread (sessions are not thread-safe).
+    local = threading.local()
+
+    def worker(index):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return probe_task(local.session, url, headers)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        latencies = list(executor.map(worker, range(arguments.requests)))
+        elapsed_time = time.perf_counter() - start
+
+    throughput = len(latencies) / elapsed_time
+    mean_latency = sum(latencies) / len(latencies)
+
+    # Little's law; average number of requests being served at any time (the
+    # measured latency also includes the time spent waiting for a thread).
+    in_flight = throughput * arguments.latency / 1000
+
+    return throughput, mean_latency, in_flight
+
+for base_url in arguments.urls:
+    print(base_url)
+
+    for concurrency in CONCURRENCY_LEVELS:
+        throughput, mean_latency, in_flight = run(base_url, concurrency)
+        print(f"  {concurrency:4d} clients: {throughput:8.1f} requests/s, {mean_latency * 1000:7.1f} ms mean latency, {in_flight:6.1f} requests in flight")
+
+    print("")
@@ -0,0 +1,122 @@
+import json
+import time
+import requests
+from faker import Faker
+
+# BASE_URL = "https://tasks.byteplug.io"
+BASE_URL = "http://127.0.0.1:8000"
+
+TASK_COUNT = 100
+ROUND_COUNT = 5
+
+LIST_DOCUMENT = {'limit': TASK_COUNT, 'cursor': None, 'status': None}
+
+MESSAGE = f"""\
+This benchmark compares retrieving {TASK_COUNT} tasks one by one with the get \
+task endpoint and all at once with the get-many endpoint. It sends hundreds of \
+requests in a row, and the tasks read one by one would be served by the task \
+cache; start the service without the rate limits and the task cache, for \
+instance:
+
+  STORAGE_ENGINE=memory STORAGE_LATENCY=20 RATE_LIMIT=0 TASK_CACHE_TTL=0 gunicorn --bind :8000 --workers 1 --threads 8 'task_tracker:with_unicorn()'
+
+Service: {BASE_URL}
+"""
+
+def print_and_exit(response):
+    print(response.status_code)
+    print(response.text)
+
+    if response.status_code == 429:
+        print("Rejected by the rate limits (start the service with RATE_LIMIT=0).")
+
+    exit(1)
+
+def read_task_cache_hits():
+    response = requests.post(BASE_URL + "/cache-stats")
+    if response.status_code != 200:
+        print_and_exit(response)
+
+    return response.json()['task-cache']['hits']
+
+def requests_post_json(url, document, headers={}):
+    return requests.post(
+        url,
+        data=json.dumps(document),
+        headers=headers | {'Content-Type': 'application/json'}
+    )
+
+def get_tasks_one_by_one(session):
+    tasks = []
+    for task_id in session.post(BASE_URL + "/tasks/list", json=LIST_DOCUMENT).json():
+        response = session.post(BASE_URL + f"/tasks/{task_id}/get")
+        if response.status_code != 200:
+            print_and_exit(response)
+
+        tasks.append(response.json())
+
+    return tasks
+
+def get_tasks_at_once(session):
+    task_ids = session.post(BASE_URL + "/tasks/list", json=LIST_DOCUMENT).json()
+    response = session.post(BASE_URL + "/tasks/get-many", json=task_ids)
+    if response.status_code != 200:
+        print_and_exit(response)
+
+    return response.json()
+
+def measure(function, session):
+    timings = []
+    for _ in range(ROUND_COUNT):
+        start = time.perf_counter()
+        function(session)
+        timings.append(time.perf_counter() - start)
+
+    return sorted(timings)[len(timings) // 2]
+
+print(MESSAGE)
+
+fake = Faker()
+document = {
+    'username': fake.user_name(),
+    'password': fake.password(special_chars=False)
+}
+response = requests_post_json(BASE_URL + "/login", document)
+if response.status_code != 200:
+    print("Login failed.")
+    print_and_exit(response)
+
+# A session is used to reuse connections, so we measure the service and not
+# the TCP handshakes.
+session = requests.Session()
+session.headers.update({"Authorization": f"Bearer {response.json()}"})
+
+print(f"Creating {TASK_COUNT} tasks...", end="\n\n")
+documents = []
+for index in range(TASK_COUNT):
+    documents.append({
+        'name': f"Task {index}",
+        'description': "Task created by the benchmark.",
+        'status': None
+    })
+
+response = session.post(BASE_URL + "/tasks/create-many", json=documents)
+if response.status_code != 200:
+    print_and_exit(response)
+
+task_ids = response.json()
+
+cache_hits = read_task_cache_hits()
+one_by_one = measure(get_tasks_one_by_one, session)
+at_once = measure(get_tasks_at_once, session)
+
+# The cache stats are the ones of the process answering (one process only).
+if read_task_cache_hits() > cache_hits:
+    print("Warning: tasks were served by the task cache (start the service with TASK_CACHE_TTL=0).", end="\n\n")
+
+print(f"List then get each task: {one_by_one * 1000:.1f} ms ({TASK_COUNT + 1} requests)")
+print(f"List then get all tasks: {at_once * 1000:.1f} ms (2 requests)")
+print(f"Speedup: {one_by_one / at_once:.1f}x", end="\n\n")
+
+print("Deleting tasks...")
+session.post(BASE_URL + "/tasks/delete-many", json=task_ids)
@@ -0,0 +1,194 @@
+import json
+import time
+import random
+import argparse
+import threading
+import requests
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from faker import Faker
+
+MESSAGE = """\
+Generate load on a local instance of the service from many concurrent virtual \
+users, each running a weighted mix of endpoints, and report the latency \
+percentiles and throughput of each endpoint. Start the service with the memory \
+engine (or against the Firestore emulator), for instance:
+
+  STORAGE_ENGINE=memory RATE_LIMIT=0 gunicorn --bind :8000 --workers 1 --threads 8 'task_tracker:with_unicorn()'
+"""
+
+BASE_URL = "http://127.0.0.1:8000"
+
+USER_COUNT = 32
+DURATION = 30
+
+# Relative weights of the endpoints called by the virtual users (after they
+# logged in).
+ENDPOINT_MIX = {
+    'tasks/create':      10,
+    'tasks/get':         40,
+    'tasks/update':      15,
+    'tasks/list':        20,
+    'tasks/mark-all-as': 5,
+    'status':            5,
+    'login':             5
+}
+
+# Number of tasks of a virtual user above which it stops creating new ones
+# (so it stays below the maximum number of tasks per user).
+MAX_TASK_COUNT = 50
+
+parser = argparse.ArgumentParser(description=MESSAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--url', default=BASE_URL, help="base URL of the service")
+parser.add_argument('--users', type=int, default=USER_COUNT, help="number of concurrent virtual users")
+parser.add_argument('--duration', type=int, default=DURATION, help="duration of the run (in seconds)")
+parser.add_argument('--output', help="path of the JSON file the results are saved to")
+arguments = parser.parse_args()
+
+# Latencies (in seconds) and error counts, by endpoint.
+latencies = {endpoint: [] for endpoint in ENDPOINT_MIX}
+error_counts = {endpoint: 0 for endpoint in ENDPOINT_MIX}
+lock = threading.Lock()
+
+def call(session, endpoint, path, document=None):
+    start = time.perf_counter()
+    if document is None:
+        response = session.post(arguments.url + path)
+    else:
+        response = session.post(arguments.url + path, json=document)
+    elapsed_time = time.perf_counter() - start
+
+    with lock:
+        latencies[endpoint].append(elapsed_time)
+        if response.status_code >= 400:
+            error_counts[endpoint] += 1
+
+    return response
+
+class VirtualUser:
+    def __init__(self, username, password):
+        self.session = requests.Session()
+        self.credentials = {'username': username, 'password': password}
+        self.task_ids = []
+
+    def login(self):
+        response = call(self.session, 'login', "/login", self.credentials)
+        if response.status_code == 200:
+            self.session.headers.update({"Authorization": f"Bearer {response.json()}"})
+
+    def create_task(self):
+        if len(self.task_ids) >= MAX_TASK_COUNT:
+            return self.get_task()
+
+        document = {
+            'name': "Task",
+            'description': "Task created by the load benchmark.",
+            'status': None
+        }
+        response = call(self.session, 'tasks/create', "/tasks/create", document)
+        if response.status_code == 200:
+            self.task_ids.append(response.json())
+
+    def get_task(self):
+        if not self.task_ids:
+            return self.create_task()
+
+        task_id = random.choice(self.task_ids)
+        call(self.session, 'tasks/get', f"/tasks/{task_id}/get")
+
+    def update_task(self):
+        if not self.task_ids:
+            return self.create_task()
+
+        task_id = random.choice(self.task_ids)
+        document = {
+            'name': None,
+            'description': None,
+            'status': random.choice(('not-done', 'in-progress', 'done'))
+        }
+        call(self.session, 'tasks/update', f"/tasks/{task_id}/update", document)
+
+    def list_tasks(self):
+        call(self.session, 'tasks/list', "/tasks/list", {'limit': None, 'cursor': None, 'status': None})
+
+    def mark_all_tasks_as(self):
+        status = random.choice(('not-done', 'in-progress', 'done'))
+        call(self.session, 'tasks/mark-all-as', "/tasks/mark-all-as", status)
+
+    def probe_status(self):
+        call(self.session, 'status', "/status")
+
+    def run(self, deadline):
+        actions = {
+            'tasks/create':      self.create_task,
+            'tasks/get':         self.get_task,
+            'tasks/update':      self.update_task,
+            'tasks/list':        self.list_tasks,
+            'tasks/mark-all-as': self.mark_all_tasks_as,
+            'status':            self.probe_status,
+            'login':             self.login
+        }
+        endpoints = list(ENDPOINT_MIX.keys())
+        weights = list(ENDPOINT_MIX.values())
+
+        self.login()
+        while time.monotonic() < deadline:
+            endpoint = random.choices(endpoints, weights)[0]
+            actions[endpoint]()
+
+def percentile(values, fraction):
+    index = min(int(len(values) * fraction), len(values) - 1)
+    return values[index]
+
+fake = Faker()
+virtual_users = [
+    VirtualUser(f"{fake.user_name()[:8]}{index}", fake.password(special_chars=False))
+    for index in range(arguments.users)
+]
+
+print(f"Running {arguments.users} virtual users for {arguments.duration}s against {arguments.url}...", end="\n\n")
+
+deadline = time.monotonic() + arguments.duration
+start = time.perf_counter()
+with ThreadPoolExecutor(max_workers=arguments.users) as executor:
+    for future in [executor.submit(virtual_user.run, deadline) for virtual_user in virtual_users]:
+        future.result()
+elapsed_time = time.perf_counter() - start
+
+results = {}
+for endpoint, values in latencies.items():
+    if not values:
+        continue
+
+    values.sort()
+    results[endpoint] = {
+        'requests': len(values),
+        'errors':   error_counts[endpoint],
+        'rps':      len(values) / elapsed_time,
+        'p50':      percentile(values, 0.50) * 1000,
+        'p95':      percentile(values, 0.95) * 1000,
+        'p99':      percentile(values, 0.99) * 1000
+    }
+
+print(f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+for endpoint, result in results.items():
+    print(f"{endpoint:<20}{result['requests']:>10}{result['errors']:>8}{result['rps']:>10.1f}"
+          f"{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}")
+
+total_count = sum(result['requests'] for result in results.values())
+print("")
+print(f"Total: {total_count} requests in {elapsed_time:.1f}s ({total_count / elapsed_time:.1f} requests/s)")
+
+if arguments.output:
+    document = {
+        'date':     datetime.now().isoformat(),
+        'url':      arguments.url,
+        'users':    arguments.users,
+        'duration': elapsed_time,
+        'mix':      ENDPOINT_MIX,
+        'results':  results
+    }
+    with open(arguments.output, 'w') as file:
+        json.dump(document, file, indent=2)
+
+    print(f"Results saved to {arguments.output}")
@@ -0,0 +1,32 @@
+import timeit
+from byteplug.endpoints import endpoint
+from metrics import instrument_endpoint, InstrumentedStorage
+from storage import MemoryStorage
+
+# Measure the overhead of the instrumentation (see metrics.py) on the hot
+# path; an endpoint doing a single storage call, with and without metrics.
+
+CALL_COUNT = 100000
+
+storage = MemoryStorage()
+user, _ = storage.get_or_create_user("benchmark", "benchmark1")
+task_id = storage.create_task(user['key'], "Task", None, 'not-done', 1)
+
+instrumented_storage = InstrumentedStorage(storage)
+
+@endpoint("get-task")
+def get_task():
+    return storage.get_task(user['key'], task_id)
+
+@endpoint("get-task")
+def get_task_with_instrumented_storage():
+    return instrumented_storage.get_task(user['key'], task_id)
+
+instrumented_get_task = instrument_endpoint(get_task_with_instrumented_storage)
+
+plain_time = timeit.timeit(get_task, number=CALL_COUNT) / CALL_COUNT
+instrumented_time = timeit.timeit(instrumented_get_task, number=CALL_COUNT) / CALL_COUNT
+
+print(f"Without metrics: {plain_time * 1e6:.2f} µs per call")
+print(f"With metrics:    {instrumented_time * 1e6:.2f} µs per call")
+print(f"Overhead:        {(instrumented_time - plain_time) * 1e6:.2f} µs per call")
@@ -0,0 +1,116 @@
+import json
+import timeit
+import argparse
+import compression
+import serializer
+from storage import generate_id
+from ndjson import task_record
+
+# Measure, for the documents of the list-heavy endpoints, the time spent
+# serializing them (with the standard library, as done by the Endpoints
+# library, and with the fast serializer, see serializer.py) and the number of
+# bytes sent on the wire (raw and compressed, see compression.py).
+#
+# The fast serializer is orjson if it's installed, and Brotli is measured only
+# if it's installed.
+#
+# In the Flask serving mode, the documents of the endpoints are serialized by
+# the Endpoints library, with the standard library; the fast serializer
+# doesn't apply to them. It does in the async serving mode (which serializes
+# all its documents itself), and in both modes for the export (a plain route).
+# The 'fast in' column tells which.
+
+TASK_COUNT = 100
+
+FAST_SERIALIZER_MODES = {
+    'tasks/export': 'both'
+}
+
+def make_task(index):
+    return {
+        'name':        f"Task {index}",
+        'description': "Something that needs to be done before the end of the week.",
+        'status':      ('not-done', 'in-progress', 'done')[index % 3]
+    }
+
+def make_documents(page_size):
+    task_ids = [generate_id() for _ in range(TASK_COUNT)]
+    tasks = {task_id: make_task(index) for index, task_id in enumerate(task_ids)}
+
+    return {
+        'users/list': [generate_id() for _ in range(page_size)],
+        'tasks/list': task_ids,
+        # Same shape as make_task_items() of task_tracker.py (the fields of
+        # the task are flat, and null along with an error if it's missing).
+        'tasks/get-many': [
+            {'id': task_id} | task | {'error': None} for task_id, task in tasks.items()
+        ] + [
+            {'id': generate_id(), 'name': None, 'description': None, 'status': None, 'error': 'invalid-task-id'}
+        ],
+        'tasks/changes': {
+            'version': 1666080000123456,
+            'reset':   True,
+            'changed': [{'id': task_id} | task for task_id, task in tasks.items()],
+            'deleted': []
+        },
+        'tasks/export': [task_record(task_id, task) for task_id, task in tasks.items()],
+        'status': {
+            'user-count': 1234,
+            'task-count': 56789,
+            'average-task-per-user': str(56789 / 1234),
+            'session-duration': "60 minutes",
+            'max-task-per-user': 100
+        }
+    }
+
+def serialize_stdlib(name, document):
+    # The export is NDJSON (one record per line).
+    if name == 'tasks/export':
+        return ''.join(json.dumps(record) + '\n' for record in document)
+
+    return json.dumps(document)
+
+def serialize_fast(name, document):
+    if name == 'tasks/export':
+        return ''.join(serializer.dumps(record) + '\n' for record in document)
+
+    return serializer.dumps(document)
+
+def measure(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+parser = argparse.ArgumentParser(description="Benchmark the serialization and the compression of the responses.")
+parser.add_argument('--page-size', type=int, default=1000, help="number of user IDs in the list users response")
+parser.add_argument('--number', type=int, default=2000, help="number of serializations per measure")
+arguments = parser.parse_args()
+
+encodings = compression.supported_encodings()
+
+print(f"Fast serializer: {serializer.NAME}, encodings: {', '.join(encodings)}")
+print("")
+
+header = f"{'endpoint':<16}{'json (µs)':>11}{serializer.NAME + ' (µs)':>14}{'fast in':>9}{'raw (B)':>10}{'compact (B)':>13}"
+for encoding in encodings:
+    header += f"{encoding + ' (B)':>10}{encoding + ' (µs)':>11}"
+print(header)
+
+for name, document in make_documents(arguments.page_size).items():
+    stdlib_time = measure(lambda: serialize_stdlib(name, document), arguments.number)
+    fast_time = measure(lambda: serialize_fast(name, document), arguments.number)
+
+    raw_body = serialize_stdlib(name, document).encode()
+    body = serialize_fast(name, document).encode()
+
+    fast_modes = FAST_SERIALIZER_MODES.get(name, 'async')
+
+    line = f"{name:<16}{stdlib_time * 1e6:>11.1f}{fast_time * 1e6:>14.1f}{fast_modes:>9}{len(raw_body):>10}{len(body):>13}"
+
+    for encoding in encodings:
+        if compression.is_compressible('application/json', len(body)):
+            compressed_body = compression.compress(body, encoding)
+            compression_time = measure(lambda: compression.compress(body, encoding), arguments.number // 10)
+            line += f"{len(compressed_body):>10}{compression_time * 1e6:>11.1f}"
+        else:
+            line += f"{'-':>10}{'-':>11}"
+
+    print(line)
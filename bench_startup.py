@@ -0,0 +1,86 @@
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+MESSAGE = """\
+Measure the cold start of the service; each run starts a fresh Python process \
+which imports the entry point, creates the application and serves a first \
+request (with the Flask test client), and reports the duration of each step. \
+Run it on different commits to compare them. To measure it with the Firestore \
+engine, use the Firestore emulator, for instance:
+
+  FIRESTORE_EMULATOR_HOST=127.0.0.1:8080 python bench_startup.py
+"""
+
+RUN_COUNT = 10
+
+# Prefix of the line of the result; log messages are written to stdout as well
+# (by a background thread, so they may come after it).
+RESULT_PREFIX = 'bench-startup-result: '
+
+ENTRY_POINTS = {
+    'startup':      'startup',
+    'task_tracker': 'task_tracker'
+}
+
+# Executed in a fresh process for each run.
+SNIPPET = """
+import sys
+import json
+import time
+start_time = time.perf_counter()
+import {module}
+import_time = time.perf_counter()
+flask = {module}.with_unicorn()
+app_time = time.perf_counter()
+time.sleep({delay})
+request_time = time.perf_counter()
+response = flask.test_client().post('/login', json={{'username': 'bench', 'password': 'bench1234'}})
+first_request_time = time.perf_counter()
+sys.stdout.write({prefix!r} + json.dumps({{
+    'import':        import_time - start_time,
+    'create-app':    app_time - import_time,
+    'first-request': first_request_time - request_time,
+    'status-code':   response.status_code
+}}) + '\\n')
+"""
+
+parser = argparse.ArgumentParser(description=MESSAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--entry-point', choices=ENTRY_POINTS.keys(), default='startup', help="module creating the application")
+parser.add_argument('--runs', type=int, default=RUN_COUNT, help="number of runs")
+parser.add_argument('--delay', type=float, default=0.0, help="delay (in seconds) before the first request")
+arguments = parser.parse_args()
+
+snippet = SNIPPET.format(module=ENTRY_POINTS[arguments.entry_point], delay=arguments.delay, prefix=RESULT_PREFIX)
+
+results = []
+for _ in range(arguments.runs):
+    process = subprocess.run([sys.executable, '-c', snippet], capture_output=True, text=True)
+    if process.returncode != 0:
+        print(process.stderr)
+        exit(1)
+
+    lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if not lines:
+        print("No result in the output of the run")
+        print(process.stdout)
+        exit(1)
+
+    result = json.loads(lines[0].removeprefix(RESULT_PREFIX))
+    if result['status-code'] != 200:
+        print(f"First request failed (status code {result['status-code']})")
+        exit(1)
+
+    results.append(result)
+
+print(f"Cold start of '{arguments.entry_point}' ({arguments.runs} runs, {arguments.delay}s before the first request)", end="\n\n")
+print(f"{'step':<16}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+for step in ('import', 'create-app', 'first-request'):
+    durations = [result[step] * 1000 for result in results]
+    print(f"{step:<16}{statistics.median(durations):>12.1f}{min(durations):>10.1f}{max(durations):>10.1f}")
+
+total_durations = [(result['import'] + result['create-app'] + result['first-request']) * 1000 for result in results]
+print("")
+print(f"Time to first response (median): {statistics.median(total_durations):.1f} ms (plus the delay)")
@@ -0,0 +1,148 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+import time
+import threading
+from collections import OrderedDict
+
+# Number of prefix invalidations remembered (see LRUCache.set()); they're
+# checked one by one.
+PREFIX_INVALIDATION_COUNT = 64
+
+class LRUCache:
+    """ Size-bounded cache with least-recently-used eviction and TTL.
+
+    It can be shared by the threads of a worker; every operation takes a lock
+    but only for the duration of a dict operation.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+
+        # Entries are (value, expiration time) tuples, ordered from the least
+        # recently used to the most recently used.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Invalidations (deletions) are numbered by generation; the last ones
+        # are remembered (by key, and by prefix) so a value read before one of
+        # them is not set after it. Older ones are forgotten, and values read
+        # before the last forgotten one are never set.
+        self.generation = 0
+        self.invalidated_keys = OrderedDict()
+        self.invalidated_prefixes = OrderedDict()
+        self.forgotten_generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the value of a key, or None if it's missing or expired. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expiration_time = entry
+            if expiration_time <= time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                self.evictions += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value, ttl=None, generation=None):
+        """ Set the value of a key.
+
+        The TTL (in seconds) defaults to the one of the cache and can only be
+        shorter. When the value was read from elsewhere, pass the generation
+        of the cache taken before reading it; the value is not set if the key
+        was invalidated since (it may be stale).
+        """
+
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+
+        if ttl <= 0:
+            return
+
+        with self.lock:
+            if generation is not None and self.invalidated_since(key, generation):
+                return
+
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.remember_invalidation(self.invalidated_keys, key, self.size)
+
+    def delete_prefix(self, prefix):
+        """ Delete all keys starting with the given prefix. """
+
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                del self.entries[key]
+
+            self.remember_invalidation(self.invalidated_prefixes, prefix, PREFIX_INVALIDATION_COUNT)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+            self.generation += 1
+            self.invalidated_keys.clear()
+            self.invalidated_prefixes.clear()
+            self.forgotten_generation = self.generation
+
+    def remember_invalidation(self, invalidations, key, size):
+        # The lock must be held.
+        self.generation += 1
+
+        invalidations[key] = self.generation
+        invalidations.move_to_end(key)
+
+        while len(invalidations) > size:
+            _, generation = invalidations.popitem(last=False)
+            self.forgotten_generation = max(self.forgotten_generation, generation)
+
+    def invalidated_since(self, key, generation):
+        # The lock must be held.
+        if self.forgotten_generation > generation:
+            return True
+
+        if self.invalidated_keys.get(key, 0) > generation:
+            return True
+
+        for prefix, prefix_generation in self.invalidated_prefixes.items():
+            if prefix_generation > generation and key.startswith(prefix):
+                return True
+
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size':      len(self.entries),
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,194 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Requests of the change feed (see the 'tasks/changes' endpoint) wait for
+#   the task version of their user to change; they wait on an event of the
+#   event loop (and not in a thread), so waiting requests cost no thread.
+# - The task version of a user is watched with the storage engine (a snapshot
+#   listener with Firestore, so changes made by other instances are seen too);
+#   a single watch is shared by all the requests waiting for the same user,
+#   and it's stopped when the last of them completes.
+# - The Flask serving mode has a thread per request; its requests wait on a
+#   condition variable instead (see ThreadTaskVersionWatches), which holds
+#   their thread, so their number is limited (see MAX_LONG_POLLS).
+import time
+import asyncio
+import threading
+
+class Watch:
+    def __init__(self):
+        self.version = None
+        self.changed = asyncio.Event()
+        self.subscribed = asyncio.Event()
+        self.unsubscribe = None
+        self.waiter_count = 0
+
+    def update(self, version):
+        self.version = version
+
+        # Wake up the waiters, and start over with a new event.
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class TaskVersionWatches:
+    """ Wait for the task versions of users to change (from an event loop). """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.watches = {}
+
+    async def wait(self, user_key, version, timeout):
+        """ Wait until the task version of a user is not the given version.
+
+        It returns the new version, or the given version if it didn't change
+        within the timeout (in seconds).
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        watch = self.watches.get(user_key)
+        if watch is None:
+            watch = self.watches[user_key] = Watch()
+            watch.waiter_count += 1
+
+            # The callback may be called from another thread.
+            def callback(new_version):
+                loop.call_soon_threadsafe(watch.update, new_version)
+
+            try:
+                watch.unsubscribe = await self.storage.watch_task_version(user_key, callback)
+            except BaseException:
+                await self.release(user_key, watch)
+                raise
+            finally:
+                watch.subscribed.set()
+        else:
+            watch.waiter_count += 1
+
+        try:
+            await watch.subscribed.wait()
+            if watch.unsubscribe is None:
+                raise RuntimeError("watch of the task version failed")
+
+            # Read after the watch was subscribed, so no change is missed.
+            current_version = await self.storage.get_task_version(user_key)
+
+            while current_version == version:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    await asyncio.wait_for(watch.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+                current_version = watch.version
+
+            return current_version
+        finally:
+            await self.release(user_key, watch)
+
+    async def release(self, user_key, watch):
+        watch.waiter_count -= 1
+        if watch.waiter_count > 0:
+            return
+
+        if self.watches.get(user_key) is watch:
+            del self.watches[user_key]
+
+        if watch.unsubscribe is not None:
+            # Stopping a listener closes its stream; it's done in a thread.
+            await asyncio.to_thread(watch.unsubscribe)
+
+class ThreadWatch:
+    def __init__(self):
+        self.version = None
+        self.update_count = 0
+        self.changed = threading.Condition()
+        self.subscribed = threading.Event()
+        self.unsubscribe = None
+        self.waiter_count = 0
+
+    def update(self, version):
+        with self.changed:
+            self.version = version
+            self.update_count += 1
+            self.changed.notify_all()
+
+class ThreadTaskVersionWatches:
+    """ Wait for the task versions of users to change (from threads). """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.watches = {}
+        self.lock = threading.Lock()
+
+    def wait(self, user_key, version, timeout):
+        """ Same as TaskVersionWatches.wait(), but blocking. """
+
+        deadline = time.monotonic() + timeout
+
+        with self.lock:
+            watch = self.watches.get(user_key)
+            subscribing = watch is None
+            if subscribing:
+                watch = self.watches[user_key] = ThreadWatch()
+
+            watch.waiter_count += 1
+
+        try:
+            if subscribing:
+                try:
+                    watch.unsubscribe = self.storage.watch_task_version(user_key, watch.update)
+                finally:
+                    watch.subscribed.set()
+            else:
+                watch.subscribed.wait()
+
+            if watch.unsubscribe is None:
+                raise RuntimeError("watch of the task version failed")
+
+            # The storage engine is not called with the condition held (the
+            # memory engine calls the callbacks with its lock held); updates
+            # made while the version is read are caught by their count.
+            with watch.changed:
+                update_count = watch.update_count
+
+            current_version = self.storage.get_task_version(user_key)
+
+            with watch.changed:
+                while current_version == version:
+                    if watch.update_count != update_count:
+                        update_count = watch.update_count
+                        current_version = watch.version
+                        continue
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    watch.changed.wait(remaining)
+
+            return current_version
+        finally:
+            self.release(user_key, watch)
+
+    def release(self, user_key, watch):
+        with self.lock:
+            watch.waiter_count -= 1
+            if watch.waiter_count > 0:
+                return
+
+            if self.watches.get(user_key) is watch:
+                del self.watches[user_key]
+
+        if watch.unsubscribe is not None:
+            watch.unsubscribe()
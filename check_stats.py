@@ -0,0 +1,130 @@
+import json
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from faker import Faker
+
+# BASE_URL = "https://tasks.byteplug.io"
+BASE_URL = "http://127.0.0.1:8000"
+
+# Number of tasks created (and deleted) concurrently, and number of threads
+# issuing the requests.
+TASK_COUNT = 50
+KEPT_TASK_COUNT = 10
+THREAD_COUNT = 16
+
+def print_and_exit(response):
+    print(response.status_code)
+    print(response.text)
+    exit(1)
+
+# The bursts of requests exceed the default rate limits of the service (run it
+# with RATE_LIMIT=0); rejected requests are retried after the delay it asks for
+# otherwise.
+def post(url, **kwargs):
+    while True:
+        response = requests.post(url, **kwargs)
+        if response.status_code != 429:
+            return response
+
+        time.sleep(int(response.headers.get('Retry-After', 1)))
+
+def requests_post_json(url, document, headers={}):
+    return post(
+        url,
+        data=json.dumps(document),
+        headers=headers | {'Content-Type': 'application/json'}
+    )
+
+def probe_status():
+    response = post(BASE_URL + "/status")
+    if response.status_code != 200:
+        print("Failed to probe service status.")
+        print_and_exit(response)
+
+    document = response.json()
+    return document['user-count'], document['task-count']
+
+def create_task(name):
+    document = {
+        'name': name,
+        'description': None,
+        'status': None
+    }
+    response = requests_post_json(BASE_URL + "/tasks/create", document, headers)
+    if response.status_code != 200:
+        print(f"Failed to create task {name}.")
+        print_and_exit(response)
+
+    return response.json()
+
+def is_error(response, tag):
+    return response.status_code == 500 and response.json().get('code') == tag
+
+def delete_task(task_id):
+    # Only one of the concurrent deletions of a task succeeds; the other
+    # returns the 'invalid-task-id' error.
+    response = post(BASE_URL + f"/tasks/{task_id}/delete", headers=headers)
+    if response.status_code == 204:
+        return True
+
+    if is_error(response, 'invalid-task-id'):
+        return False
+
+    print(f"Failed to delete task {task_id}.")
+    print_and_exit(response)
+
+MESSAGE = f"""\
+This script checks that the user and task counters reported by the status \
+endpoint stay exact under concurrent creations and deletions. It expects to be \
+the only client of the service while it runs (use a local instance, started \
+with RATE_LIMIT=0; otherwise the requests rejected by the rate limits are \
+retried, which slows the script down).
+
+Service: {BASE_URL}
+"""
+print(MESSAGE)
+
+user_count_before, task_count_before = probe_status()
+print(f"Before: {user_count_before} users and {task_count_before} tasks.")
+
+fake = Faker()
+document = {
+    'username': fake.user_name(),
+    'password': fake.password(special_chars=False)
+}
+response = requests_post_json(BASE_URL + "/login", document)
+if response.status_code != 200:
+    print("Login failed.")
+    print_and_exit(response)
+
+headers = {"Authorization": f"Bearer {response.json()}"}
+
+with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+    names = [f"Task {index}" for index in range(TASK_COUNT + KEPT_TASK_COUNT)]
+    task_ids = list(executor.map(create_task, names))
+
+    # Each task is deleted twice at the same time; the second deletion must
+    # not decrement the counter again.
+    deleted_task_ids = task_ids[:TASK_COUNT]
+    deleted = list(executor.map(delete_task, deleted_task_ids + deleted_task_ids))
+
+if deleted.count(True) != TASK_COUNT:
+    print(f"{deleted.count(True)} deletions succeeded (expected {TASK_COUNT}).")
+    exit(1)
+
+user_count_after, task_count_after = probe_status()
+print(f"After: {user_count_after} users and {task_count_after} tasks.", end="\n\n")
+
+expected_user_count = user_count_before + 1
+expected_task_count = task_count_before + KEPT_TASK_COUNT
+
+if user_count_after != expected_user_count:
+    print(f"User count is {user_count_after} (expected {expected_user_count}).")
+    exit(1)
+
+if task_count_after != expected_task_count:
+    print(f"Task count is {task_count_after} (expected {expected_task_count}).")
+    exit(1)
+
+print("All OK.")
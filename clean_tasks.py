@@ -1,4 +1,3 @@
-
 # Copyright (c) 2022 - Byteplug Inc.
 #
 # This source file is part of the Byteplug toolkit for the Python programming
@@ -7,21 +6,223 @@
 #
 # Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
 
-from datetime import datetime, timedelta
-from fireo.models import Model
-from fireo.fields import TextField, DateTime
+# Few notes:
+# - Only the expired users are queried (the filtering is done by Firestore) and
+#   only their username is fetched (to delete their lookup document).
+# - A user is deleted before its tasks, with a precondition on its update time
+#   so it's kept if it was active (or its tasks changed) since it was queried.
+#   Once it's gone, the service can't write its tasks anymore (they're always
+#   written along with their user), so none is created behind the job.
+# - A marker is written (in the 'deleted_users' collection) along with the
+#   deletion of the user, and deleted once its tasks (and the tombstones of
+#   its deleted tasks) are; the users whose marker remains (the job stopped
+#   halfway) are swept again on the next run. With --scan-orphans, the users
+#   deleted before the markers existed are found too.
+# - Users are processed concurrently by a bounded pool of workers.
+# - The tombstones of the tasks deleted more than CHANGES_RETENTION ago (of
+#   all users) are deleted too, with a collection group query; it needs a
+#   collection group index on the 'version' field of 'deleted_tasks' (see
+#   README.md). A margin is kept so the clock of the service instances (which
+#   decides which versions are too old) doesn't need to be exact.
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import fireo
+from fireo import db
+from google.api_core.exceptions import FailedPrecondition
+from stats import increment_counters
+from storage import FIRESTORE_BATCH_SIZE, CHANGES_RETENTION
+from firestore_storage import username_reference
+from logs import setup_logging, log
+
+SESSION_DURATION = timedelta(minutes=60)
+WORKER_COUNT = 8
+
+CLOCK_MARGIN = timedelta(minutes=5)
+
+DELETED_USERS_COLLECTION = "deleted_users"
+
+# Leave room for the counter increment in each batch.
+TASK_BATCH_SIZE = FIRESTORE_BATCH_SIZE - 1
+
+logger = setup_logging('clean_tasks')
+
+def delete_user(user_snapshot, dry_run):
+    """ Delete a user, then its tasks.
+
+    The user is deleted only if it didn't change since it was queried, so a
+    user active in the meantime is kept. It returns the number of deleted
+    documents (0 if the user was kept).
+    """
+
+    user_reference = user_snapshot.reference
+
+    log(logger, logging.INFO, "Deleting user", user_id=user_snapshot.id, dry_run=dry_run)
+    if dry_run:
+        return 2 + sweep_user(user_reference, dry_run)
+
+    batch = fireo.batch()
+    batch.delete(user_reference, option=db.conn.write_option(last_update_time=user_snapshot.update_time))
+    batch.delete(username_reference(user_snapshot.get('username')))
+    batch.set(deleted_user_reference(user_snapshot.id), {'deleted_at': datetime.now(timezone.utc)})
+    increment_counters(user_delta=-1, writer=batch)
+
+    try:
+        batch.commit()
+    except FailedPrecondition:
+        log(logger, logging.INFO, "User active again, kept", user_id=user_snapshot.id)
+        return 0
+
+    return 2 + sweep_user(user_reference, dry_run)
+
+def sweep_user(user_reference, dry_run):
+    """ Delete the tasks (and the tombstones) of a deleted user, then its
+    deletion marker.
+
+    It returns the number of deleted tasks and tombstones.
+    """
+
+    tasks = user_reference.collection("tasks")
+    task_references = [snapshot.reference for snapshot in tasks.select([]).stream()]
+
+    deleted_tasks = user_reference.collection("deleted_tasks")
+    tombstone_references = [snapshot.reference for snapshot in deleted_tasks.select([]).stream()]
+
+    if dry_run:
+        return len(task_references) + len(tombstone_references)
+
+    for index in range(0, len(task_references), TASK_BATCH_SIZE):
+        chunk = task_references[index:index + TASK_BATCH_SIZE]
+
+        batch = fireo.batch()
+        for task_reference in chunk:
+            batch.delete(task_reference)
+        increment_counters(task_delta=-len(chunk), writer=batch)
+        batch.commit()
+
+    for index in range(0, len(tombstone_references), FIRESTORE_BATCH_SIZE):
+        batch = fireo.batch()
+        for tombstone_reference in tombstone_references[index:index + FIRESTORE_BATCH_SIZE]:
+            batch.delete(tombstone_reference)
+        batch.commit()
+
+    deleted_user_reference(user_reference.id).delete()
+
+    return len(task_references) + len(tombstone_references)
+
+def deleted_user_reference(user_id):
+    return db.conn.collection(DELETED_USERS_COLLECTION).document(user_id)
+
+def orphaned_users(scan_missing):
+    """ Stream the references of the deleted users whose tasks may remain. """
+
+    # Users whose deletion was interrupted still have their marker.
+    user_ids = set()
+    for snapshot in db.conn.collection(DELETED_USERS_COLLECTION).select([]).stream():
+        user_ids.add(snapshot.id)
+        yield db.conn.document('users/' + snapshot.id)
+
+    if not scan_missing:
+        return
+
+    # Users deleted before the markers (by a previous version of the job,
+    # which deleted the tasks first) are listed as missing documents (the
+    # ones with a marker are skipped, they're already being swept); it costs
+    # a read per user.
+    references = db.conn.collection("users").list_documents(show_missing=True)
+    for chunk in chunk_references(references, FIRESTORE_BATCH_SIZE):
+        for snapshot in db.conn.get_all(chunk, field_paths=[]):
+            if not snapshot.exists and snapshot.id not in user_ids:
+                yield snapshot.reference
+
+def expired_tombstones(cutoff):
+    """ Stream the references of the tombstones older than the cutoff. """
+
+    deleted_tasks = db.conn.collection_group("deleted_tasks").select([])
+    for snapshot in deleted_tasks.where('version', '<', cutoff).stream():
+        yield snapshot.reference
+
+    # Tombstones written before the versions were times have a number as
+    # version (a filter only matches values of its own type); they're all
+    # older than any version still in use.
+    for snapshot in deleted_tasks.where('version', '>=', 0).stream():
+        yield snapshot.reference
+
+def delete_tombstones(tombstone_references, dry_run):
+    """ Delete a chunk of tombstones, and return their number. """
+
+    if not dry_run:
+        batch = fireo.batch()
+        for tombstone_reference in tombstone_references:
+            batch.delete(tombstone_reference)
+        batch.commit()
+
+    return len(tombstone_references)
+
+def chunk_references(references, size):
+    chunk = []
+    for reference in references:
+        chunk.append(reference)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+parser = argparse.ArgumentParser(description="Delete the users whose session has expired.")
+parser.add_argument('--dry-run', action='store_true', help="list what would be deleted without deleting it")
+parser.add_argument('--workers', type=int, default=WORKER_COUNT, help="number of users processed concurrently")
+parser.add_argument('--scan-orphans', action='store_true', help="also find the tasks of users deleted by a previous version of the job")
+arguments = parser.parse_args()
+
+start_time = time.perf_counter()
+
+cutoff = datetime.now() - SESSION_DURATION
+users = db.conn.collection("users")
+query = users.where('last_updated', '<', cutoff).select(['username'])
+
+with ThreadPoolExecutor(max_workers=arguments.workers) as executor:
+    # The orphans are swept first, so the users deleted by this run are not
+    # swept twice.
+    orphan_counts = list(executor.map(
+        lambda user_reference: sweep_user(user_reference, arguments.dry_run),
+        orphaned_users(arguments.scan_orphans)
+    ))
+
+    deleted_counts = list(executor.map(
+        lambda user_snapshot: delete_user(user_snapshot, arguments.dry_run),
+        query.stream()
+    ))
+
+    tombstone_cutoff = datetime.now(timezone.utc) - CHANGES_RETENTION - CLOCK_MARGIN
+    tombstone_count = sum(executor.map(
+        lambda chunk: delete_tombstones(chunk, arguments.dry_run),
+        chunk_references(expired_tombstones(tombstone_cutoff), FIRESTORE_BATCH_SIZE)
+    ))
+
+elapsed_time = time.perf_counter() - start_time
 
-# Dirty copy-pasted from task_tracker.py; to be kept in sync!!
-class User(Model):
-    username = TextField(required=True)
-    password = TextField(required=True)
-    last_updated = DateTime(required=True)
+user_count = sum(1 for deleted_count in deleted_counts if deleted_count > 0)
+kept_count = len(deleted_counts) - user_count
+orphan_document_count = sum(orphan_counts)
+document_count = sum(deleted_counts) + orphan_document_count + tombstone_count
+throughput = document_count / elapsed_time if elapsed_time > 0 else 0.0
 
-    class Meta:
-        collection_name = "users"
+if arguments.dry_run:
+    message = f"Dry run; {user_count} users and {document_count} documents ({orphan_document_count} orphans, {tombstone_count} expired tombstones) would be deleted"
+else:
+    message = f"{user_count} users and {document_count} documents ({orphan_document_count} orphans, {tombstone_count} expired tombstones) deleted"
 
-for user_document in User.collection.fetch():
-    elapsed_time = datetime.now() - user_document.last_updated.replace(tzinfo=None)
-    if elapsed_time > timedelta(minutes=60):
-        print(f"Deleting user {user_document.id}")
-        User.collection.delete(user_document.key)
+log(logger, logging.INFO, message,
+    user_count=user_count,
+    kept_count=kept_count,
+    orphan_document_count=orphan_document_count,
+    tombstone_count=tombstone_count,
+    document_count=document_count,
+    elapsed_time=round(elapsed_time, 2),
+    throughput=round(throughput, 1),
+    dry_run=arguments.dry_run
+)
@@ -0,0 +1,174 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Concurrent identical calls (same function, same arguments) of a wrapped
+#   function are coalesced; the first call executes the function and the
+#   others wait for its result (or its exception) instead of executing it too.
+# - Optionally, results are reused for a short staleness window (in
+#   milliseconds) after they were computed, so bursts of calls that are not
+#   exactly concurrent are coalesced too. Exceptions are never reused.
+# - Endpoints also return values through context variables (the ETag of the
+#   response for instance); the values of the given context variables are
+#   captured along with the result, and set for the coalesced calls.
+# - The number of coalesced calls is exposed with the metrics (see
+#   metrics.py).
+import asyncio
+import functools
+import threading
+from cache import LRUCache
+from metrics import coalesced_calls
+
+MAX_RESULT_COUNT = 1024
+
+class Flight:
+    """ A call in progress, shared by the identical calls made meanwhile. """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+class SingleFlight:
+    """ Coalesce the concurrent identical calls of a function.
+
+    Arguments must be hashable; they're used as key of the calls. Results are
+    reused for 'window' milliseconds (0 to only coalesce concurrent calls).
+    """
+
+    def __init__(self, name, window=0, context_vars=()):
+        self.name = name
+        self.window = window / 1000
+        self.context_vars = context_vars
+
+        self.flights = {}
+        self.lock = threading.Lock()
+
+        # Results are (result, context variable values) tuples.
+        self.results = LRUCache(MAX_RESULT_COUNT, self.window)
+
+        self.calls = 0
+        self.coalesced = 0
+
+    def call(self, function, *args):
+        entry = self.results.get(args)
+        if entry is not None:
+            self.record(True, 'stale')
+            return self.replay(entry)
+
+        with self.lock:
+            flight = self.flights.get(args)
+            leader = flight is None
+            if leader:
+                flight = self.flights[args] = Flight()
+
+        self.record(not leader, 'shared')
+
+        if not leader:
+            flight.done.wait()
+            if flight.exception is not None:
+                raise flight.exception
+
+            return self.replay(flight.result)
+
+        try:
+            result = function(*args)
+            flight.result = (result, [var.get() for var in self.context_vars])
+            self.results.set(args, flight.result)
+
+            return result
+        except Exception as e:
+            flight.exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[args]
+
+            flight.done.set()
+
+    def record(self, coalesced, kind):
+        with self.lock:
+            self.calls += 1
+            if coalesced:
+                self.coalesced += 1
+
+        if coalesced:
+            coalesced_calls.increment(self.name, kind)
+
+    def replay(self, entry):
+        result, values = entry
+        for var, value in zip(self.context_vars, values):
+            var.set(value)
+
+        return result
+
+class AsyncSingleFlight(SingleFlight):
+    """ Same as SingleFlight but for coroutines (of a single event loop). """
+
+    async def call(self, function, *args):
+        entry = self.results.get(args)
+        if entry is not None:
+            self.record(True, 'stale')
+            return self.replay(entry)
+
+        future = self.flights.get(args)
+        if future is not None:
+            self.record(True, 'shared')
+
+            # Shielded so a cancelled waiter doesn't cancel the shared call.
+            return self.replay(await asyncio.shield(future))
+
+        self.record(False, 'shared')
+
+        future = self.flights[args] = asyncio.get_running_loop().create_future()
+        try:
+            result = await function(*args)
+            entry = (result, [var.get() for var in self.context_vars])
+            self.results.set(args, entry)
+            future.set_result(entry)
+
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+
+            # Retrieve it so it's not reported when nobody is waiting.
+            future.exception()
+            raise
+        finally:
+            del self.flights[args]
+
+def coalesce_endpoint(function, window=0, context_vars=()):
+    """ Wrap an endpoint so its concurrent identical calls are coalesced.
+
+    The wrapper keeps the specs (and name) of the endpoint so it can be added
+    to the endpoints in place of the endpoint.
+    """
+
+    single_flight = SingleFlight(function.__name__, window, context_vars)
+
+    @functools.wraps(function)
+    def wrapper(*args):
+        return single_flight.call(function, *args)
+
+    wrapper.single_flight = single_flight
+    return wrapper
+
+def coalesce_coroutine(function, window=0, context_vars=()):
+    """ Same as coalesce_endpoint() but for the coroutine of an endpoint. """
+
+    single_flight = AsyncSingleFlight(function.__name__, window, context_vars)
+
+    @functools.wraps(function)
+    async def wrapper(*args):
+        return await single_flight.call(function, *args)
+
+    wrapper.single_flight = single_flight
+    return wrapper
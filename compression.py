@@ -0,0 +1,65 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Responses are compressed when the client accepts it and they're large
+#   enough for it to pay off (lists of IDs, of tasks, etc.); small responses
+#   are sent as is.
+# - Brotli is preferred when it's installed (it compresses JSON better than
+#   gzip at a similar speed with a low quality); gzip is always available.
+# - Compression levels are low; responses are compressed on the fly, for each
+#   request, so speed matters more than the last bytes.
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_THRESHOLD = 1024
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/vnd.yaml')
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+def supported_encodings():
+    """ Return the supported encodings, by order of preference. """
+
+    if brotli is not None:
+        return ('br', 'gzip')
+
+    return ('gzip',)
+
+def choose_encoding(accept_encoding):
+    """ Return the encoding to use given an 'Accept-Encoding' header, or None. """
+
+    accepted = set()
+    for item in accept_encoding.split(','):
+        name, _, parameters = item.strip().partition(';')
+        parameters = parameters.replace(' ', '')
+
+        # Encodings with a null quality are refused.
+        if parameters in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+
+        accepted.add(name.strip().lower())
+
+    for encoding in supported_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+
+    return None
+
+def is_compressible(content_type, size, threshold=COMPRESSION_THRESHOLD):
+    return size >= threshold and content_type.split(';')[0].strip() in COMPRESSIBLE_TYPES
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
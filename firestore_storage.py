@@ -0,0 +1,345 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - This is the Firestore storage engine (see storage.py); it's kept apart
+#   so its dependencies are imported only when it's used.
+# - Changes of tasks write the task version of the user (the commit time)
+#   along with the tasks; each written task has the version of its last
+#   change ('version' field) and each deleted task leaves a tombstone with the
+#   version of its deletion (in the 'deleted_tasks' collection of the user).
+#   The changes after a version are then two queries away. The tombstones are
+#   deleted by clean_tasks.py once they're older than CHANGES_RETENTION.
+# - The transactions only do their reads here; their writes are made by the
+#   functions of transactions.py, which are shared with the async engine.
+import fireo
+from fireo import db
+from fireo.models import Model
+from fireo.fields import TextField, NumberField, DateTime
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.field_path import FieldPath
+from stats import read_counters, shard_reference
+from storage import DEFAULT_PAGE_SIZE, FIRESTORE_BATCH_SIZE
+from storage import Storage, UserNotFound, username_to_id, lookup_to_user
+from storage import snapshot_to_task, snapshot_to_task_version, version_to_time
+from transactions import create_user_writes, create_tasks_writes, update_tasks_writes
+from transactions import mark_tasks_writes, delete_tasks_writes
+
+class User(Model):
+    username = TextField(required=True)
+    password = TextField(required=True)
+    last_updated = DateTime(required=True)
+    task_count = NumberField(int_only=True)
+
+    class Meta:
+        collection_name = "users"
+
+class Task(Model):
+    name = TextField(required=True)
+    description = TextField()
+    status = TextField(required=True)
+
+    class Meta:
+        collection_name = "tasks"
+
+def user_to_dict(user_document):
+    return {
+        'key':          user_document.key,
+        'username':     user_document.username,
+        'password':     user_document.password,
+        'last_updated': user_document.last_updated,
+        'task_count':   user_document.task_count or 0
+    }
+
+def task_to_dict(task_document):
+    return {
+        'name':        task_document.name,
+        'description': task_document.description,
+        'status':      task_document.status
+    }
+
+# Only the IDs are fetched (the documents are projected to no fields) and they
+# are ordered by ID so the last ID of a page can be used as a cursor. Filtering
+# on a field by equality doesn't need a composite index.
+def list_document_ids(collection, limit, cursor, filters={}):
+    query = collection.select([])
+    for field, value in filters.items():
+        query = query.where(field, '==', value)
+
+    query = query.order_by(FieldPath.document_id())
+
+    if cursor:
+        query = query.start_after({FieldPath.document_id(): cursor})
+
+    if not limit:
+        limit = DEFAULT_PAGE_SIZE
+
+    return [snapshot.id for snapshot in query.limit(limit).stream()]
+
+def username_reference(username):
+    return db.conn.collection("usernames").document(username_to_id(username))
+
+# The lookup document is read again within the transaction so concurrent first
+# logins with the same username create only one user. A user created before
+# the lookup documents (not migrated yet) is found by its username instead,
+# and its lookup document is created.
+@fireo.transactional
+def create_user_transaction(transaction, username, password):
+    lookup = username_reference(username)
+
+    snapshot = lookup.get(transaction=transaction)
+    if snapshot.exists:
+        return lookup_to_user(snapshot), False
+
+    query = db.conn.collection("users").where('username', '==', username).select(['password', 'last_updated'])
+    legacy_snapshots = query.stream(transaction=transaction)
+
+    return create_user_writes(transaction, db.conn, lookup, legacy_snapshots, username, password)
+
+# The task count of the user is read within the transaction so concurrent
+# creations can't exceed the maximum number of tasks.
+@fireo.transactional
+def create_tasks_transaction(transaction, user_key, tasks, max_task_count):
+    user_reference = db.conn.document(user_key)
+    snapshot = user_reference.get(field_paths=['task_count'], transaction=transaction)
+
+    return create_tasks_writes(transaction, db.conn, snapshot, tasks, max_task_count)
+
+# The tasks are read again within the transaction (in a single batched read)
+# and only those which still exist, and are not already in the given status,
+# are written; tasks deleted since they were listed are skipped (an update
+# would fail the commit with NotFound, and a set would recreate them).
+@fireo.transactional
+def mark_tasks_transaction(transaction, user_key, references, status):
+    task_snapshots = list(transaction.get_all(references))
+    mark_tasks_writes(transaction, db.conn.document(user_key), task_snapshots, status)
+
+# The tasks are read within the transaction so the counters are decremented
+# only once, even if the same tasks are deleted concurrently; they're all read
+# in a single batched read.
+@fireo.transactional
+def delete_tasks_transaction(transaction, user_key, references):
+    deleted_ids = {snapshot.id for snapshot in transaction.get_all(references) if snapshot.exists}
+    if not deleted_ids:
+        return deleted_ids
+
+    delete_tasks_writes(transaction, db.conn, db.conn.document(user_key), deleted_ids)
+    return deleted_ids
+
+class FirestoreStorage(Storage):
+    def get_or_create_user(self, username, password):
+        # Existing users (the common case) cost a single point read.
+        snapshot = username_reference(username).get()
+        if snapshot.exists:
+            return lookup_to_user(snapshot), False
+
+        return create_user_transaction(fireo.transaction(), username, password)
+
+    def get_user(self, user_id):
+        user_document = User.collection.get('users/' + user_id)
+        if user_document is None:
+            return None
+
+        return user_to_dict(user_document)
+
+    def list_user_ids(self, limit, cursor):
+        return list_document_ids(db.conn.collection("users"), limit, cursor)
+
+    def touch_users(self, user_keys, last_updated):
+        # Only the field is written (the rest of the user is not read), in
+        # batches. Updates fail if the user doesn't exist (it doesn't create
+        # partial users); a batch with a deleted user is written again one
+        # user at a time.
+        references = [db.conn.document(user_key) for user_key in user_keys]
+
+        for index in range(0, len(references), FIRESTORE_BATCH_SIZE):
+            chunk = references[index:index + FIRESTORE_BATCH_SIZE]
+
+            batch = fireo.batch()
+            for reference in chunk:
+                batch.update(reference, {'last_updated': last_updated})
+
+            try:
+                batch.commit()
+            except NotFound:
+                for reference in chunk:
+                    try:
+                        reference.update({'last_updated': last_updated})
+                    except NotFound:
+                        pass
+
+    def create_task(self, user_key, name, description, status, max_task_count):
+        task = {
+            'name':        name,
+            'description': description,
+            'status':      status
+        }
+
+        task_ids = self.create_tasks(user_key, [task], max_task_count)
+        if task_ids is None:
+            return None
+
+        return task_ids[0]
+
+    def create_tasks(self, user_key, tasks, max_task_count):
+        # All tasks are created in a single transaction (the maximum number of
+        # tasks per user is well below the limit of writes per transaction).
+        return create_tasks_transaction(fireo.transaction(), user_key, tasks, max_task_count)
+
+    def get_task(self, user_key, task_id):
+        task_document = Task.collection.get(user_key + '/tasks/' + task_id)
+        if task_document is None:
+            return None
+
+        return task_to_dict(task_document)
+
+    def get_tasks(self, user_key, task_ids):
+        # Fireo's get_all() issues one read per key; the client's get_all()
+        # reads all documents in a single batched read.
+        references = [db.conn.document(user_key + '/tasks/' + task_id) for task_id in set(task_ids)]
+
+        tasks = {}
+        for snapshot in db.conn.get_all(references):
+            if snapshot.exists:
+                tasks[snapshot.id] = snapshot_to_task(snapshot)
+
+        return tasks
+
+    def update_task(self, user_key, task_id, fields):
+        task_reference = db.conn.document(user_key + '/tasks/' + task_id)
+
+        # Nothing to update; only check the task exists (without its fields).
+        if not fields:
+            return task_reference.get(field_paths=[]).exists
+
+        # Only the given fields are written (along with the task version of
+        # the user), in a single batched write and without reading anything.
+        # The commit fails (with NotFound) if the task or the user doesn't
+        # exist; they're told apart only then.
+        user_reference = db.conn.document(user_key)
+
+        batch = fireo.batch()
+        update_tasks_writes(batch, user_reference, [task_reference], fields)
+
+        try:
+            batch.commit()
+        except NotFound:
+            if not user_reference.get(field_paths=[]).exists:
+                raise UserNotFound(user_key)
+            return False
+
+        return True
+
+    def delete_task(self, user_key, task_id):
+        return len(self.delete_tasks(user_key, [task_id])) > 0
+
+    def delete_tasks(self, user_key, task_ids):
+        references = [db.conn.document(user_key + '/tasks/' + task_id) for task_id in set(task_ids)]
+        if not references:
+            return set()
+
+        try:
+            return delete_tasks_transaction(fireo.transaction(), user_key, references)
+        except NotFound:
+            raise UserNotFound(user_key)
+
+    def list_task_ids(self, user_key, limit, cursor, status=None):
+        tasks = db.conn.document(user_key).collection("tasks")
+        return list_document_ids(tasks, limit, cursor, {'status': status} if status else {})
+
+    def count_tasks(self, user_key, statuses):
+        # Aggregation queries; they're billed one read per batch of (up to)
+        # 1000 index entries, and no document is read.
+        tasks = db.conn.document(user_key).collection("tasks")
+
+        counts = {}
+        for status in statuses:
+            results = tasks.where('status', '==', status).count().get()
+            counts[status] = results[0][0].value
+
+        return counts
+
+    def iterate_tasks(self, user_key, page_size):
+        tasks = db.conn.document(user_key).collection("tasks")
+        query = tasks.order_by(FieldPath.document_id()).limit(page_size)
+
+        cursor = None
+        while True:
+            page_query = query
+            if cursor:
+                page_query = query.start_after({FieldPath.document_id(): cursor})
+
+            snapshots = list(page_query.stream())
+            for snapshot in snapshots:
+                yield snapshot.id, snapshot_to_task(snapshot)
+
+            if len(snapshots) < page_size:
+                return
+
+            cursor = snapshots[-1].id
+
+    def mark_all_tasks_as(self, user_key, status):
+        # Only the tasks that are not already in the given status are updated,
+        # and only their status field is written (along with their version).
+        user_reference = db.conn.document(user_key)
+        query = user_reference.collection("tasks").where('status', '!=', status).select([])
+
+        # Each transaction also writes the task version of the user.
+        def commit(references):
+            try:
+                mark_tasks_transaction(fireo.transaction(), user_key, references, status)
+            except NotFound:
+                raise UserNotFound(user_key)
+
+        references = []
+        for task_snapshot in query.stream():
+            references.append(task_snapshot.reference)
+
+            if len(references) == FIRESTORE_BATCH_SIZE - 1:
+                commit(references)
+                references = []
+
+        if references:
+            commit(references)
+
+    def get_task_version(self, user_key):
+        snapshot = db.conn.document(user_key).get(field_paths=['task_version'])
+        return snapshot_to_task_version(snapshot)
+
+    def list_task_changes(self, user_key, version):
+        user_reference = db.conn.document(user_key)
+
+        if version == 0:
+            tasks = user_reference.collection("tasks").stream()
+            return {snapshot.id: snapshot_to_task(snapshot) for snapshot in tasks}, []
+
+        tasks = user_reference.collection("tasks").where('version', '>', version_to_time(version)).stream()
+        changed_tasks = {snapshot.id: snapshot_to_task(snapshot) for snapshot in tasks}
+
+        deleted_tasks = user_reference.collection("deleted_tasks").where('version', '>', version_to_time(version))
+        deleted_ids = [snapshot.id for snapshot in deleted_tasks.select([]).stream()]
+
+        return changed_tasks, deleted_ids
+
+    def watch_task_version(self, user_key, callback):
+        # The listener runs in a background thread of the client, and it's
+        # called with the current version first.
+        def on_snapshot(snapshots, changes, read_time):
+            for snapshot in snapshots:
+                callback(snapshot_to_task_version(snapshot))
+
+        watch = db.conn.document(user_key).on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+    def read_counters(self):
+        return read_counters()
+
+    def warm_up(self):
+        # Create the client and open its connection with a single read (of the
+        # metadata of a counter shard).
+        shard_reference(0).get(field_paths=[])
@@ -0,0 +1,122 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Log messages are written as JSON lines (one object per message, with the
+#   'severity' and 'message' fields Cloud Logging understands) along with
+#   their fields.
+# - Threads logging a message only put it in a queue; it's formatted and
+#   written to stdout by a background thread, so requests never wait on the
+#   stdout lock. Only the arguments of the message are merged beforehand;
+#   the exception (if any) is kept along and formatted by the background
+#   thread too, in its own field.
+# - Messages logged on the hot path can be sampled; only a fraction of them
+#   is logged.
+# - Secrets must never be logged; the values of the fields named after them
+#   are redacted.
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# Fraction (between 0 and 1) of the sampled messages which are logged.
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.1))
+
+SECRET_FIELDS = ('token', 'password', 'authorization', 'secret')
+
+def redact(fields):
+    return {
+        name: '[redacted]' if name.lower() in SECRET_FIELDS else value
+        for name, value in fields.items()
+    }
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time':     datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'severity': record.levelname,
+            'logger':   record.name,
+            'message':  record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+
+        return json.dumps(entry, default=str)
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """ Put the messages in a queue of the process, unformatted.
+
+    The stock handler formats the message (traceback included) before putting
+    it in the queue, and drops the exception, so it can be pickled; the queue
+    here never leaves the process.
+    """
+
+    def prepare(self, record):
+        # The arguments are merged now; they may change before the message
+        # is formatted.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+listener = None
+
+def setup_logging(name):
+    """ Make the given logger (and its children) log in the background.
+
+    It's safe to call it more than once; the background thread is started only
+    once, and stopped when the process exits (after the remaining messages are
+    written).
+    """
+
+    global listener
+
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+
+    if listener is None:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JSONFormatter())
+
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+    if not any(isinstance(handler, logging.handlers.QueueHandler) for handler in logger.handlers):
+        logger.addHandler(LocalQueueHandler(listener.queue))
+        logger.propagate = False
+
+    return logger
+
+def log(logger, level, message, sampled=False, **fields):
+    """ Log a message along with its fields (secrets are redacted).
+
+    If it's sampled, only a fraction of the calls (see LOG_SAMPLE_RATE) log
+    the message.
+    """
+
+    if not logger.isEnabledFor(level):
+        return
+
+    if sampled and random.random() >= LOG_SAMPLE_RATE:
+        return
+
+    logger.log(level, message, extra={'fields': redact(fields)})
@@ -0,0 +1,308 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Endpoints and storage engines are instrumented by wrapping them; endpoints
+#   record their latency and errors, and storage engines record the latency of
+#   each method and the number of reads and writes of the request they're
+#   called from (tracked with a context variable, so it works for threads and
+#   coroutines alike).
+# - Metrics are kept per process and exposed in the Prometheus text format.
+# - It's on the hot path of every request; recording a value is a bisect and
+#   a few increments under a lock held by a single histogram.
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from byteplug.endpoints import EndpointError
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500)
+
+# The storage methods that only read (all others write).
+READ_METHODS = (
+    'get_or_create_user',
+    'get_user',
+    'list_user_ids',
+    'get_task',
+    'get_tasks',
+    'list_task_ids',
+    'count_tasks',
+    'iterate_tasks',
+    'get_task_version',
+    'list_task_changes',
+    'watch_task_version',
+    'read_counters'
+)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+        # The last count is for the values above the last bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+class HistogramFamily:
+    """ Histograms with the same buckets, mapped by label value. """
+
+    def __init__(self, name, description, label, buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def get(self, label_value):
+        histogram = self.histograms.get(label_value)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(label_value, Histogram(self.buckets))
+
+        return histogram
+
+    def to_text(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram"
+        ]
+
+        for label_value, histogram in sorted(self.histograms.items()):
+            counts, total = histogram.snapshot()
+            label = f'{self.label}="{label_value}"'
+
+            cumulative_count = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative_count += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bucket}"}} {cumulative_count}')
+
+            cumulative_count += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative_count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative_count}')
+
+        return lines
+
+class Counter:
+    """ Counters mapped by label values. """
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def increment(self, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + 1
+
+    def to_text(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter"
+        ]
+
+        with self.lock:
+            values = sorted(self.values.items())
+
+        for label_values, value in values:
+            label = ','.join(f'{name}="{value_}"' for name, value_ in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{label}}} {value}')
+
+        return lines
+
+endpoint_latency = HistogramFamily(
+    "task_tracker_endpoint_latency_seconds",
+    "Time spent executing the endpoints.",
+    "endpoint",
+    LATENCY_BUCKETS
+)
+endpoint_errors = Counter(
+    "task_tracker_endpoint_errors_total",
+    "Errors returned by the endpoints, by error code.",
+    ("endpoint", "code")
+)
+request_reads = HistogramFamily(
+    "task_tracker_request_storage_reads",
+    "Storage reads issued by each request.",
+    "endpoint",
+    COUNT_BUCKETS
+)
+request_writes = HistogramFamily(
+    "task_tracker_request_storage_writes",
+    "Storage writes issued by each request.",
+    "endpoint",
+    COUNT_BUCKETS
+)
+requests_rejected = Counter(
+    "task_tracker_requests_rejected_total",
+    "Requests rejected by the admission control, by reason.",
+    ("endpoint", "reason")
+)
+coalesced_calls = Counter(
+    "task_tracker_coalesced_calls_total",
+    "Calls coalesced with an identical call (in progress or recent), by function.",
+    ("function", "kind")
+)
+storage_latency = HistogramFamily(
+    "task_tracker_storage_latency_seconds",
+    "Time spent in the storage engine calls.",
+    "method",
+    LATENCY_BUCKETS
+)
+
+# The number of storage reads and writes of the request being processed (a
+# mutable [reads, writes] list).
+request_storage_calls = contextvars.ContextVar('request_storage_calls', default=None)
+
+def endpoint_name(function):
+    specs = function.specs
+    if specs['collection']:
+        return specs['collection'] + '/' + specs['path']
+
+    return specs['path']
+
+def record_request(name, start_time, storage_calls, error_code):
+    endpoint_latency.get(name).observe(time.perf_counter() - start_time)
+    request_reads.get(name).observe(storage_calls[0])
+    request_writes.get(name).observe(storage_calls[1])
+
+    if error_code is not None:
+        endpoint_errors.increment(name, error_code)
+
+def instrument_endpoint(function):
+    """ Wrap an endpoint to record its latency, errors and storage calls.
+
+    The wrapper keeps the specs (and name) of the endpoint so it can be added
+    to the endpoints in place of the endpoint.
+    """
+
+    name = endpoint_name(function)
+
+    @functools.wraps(function)
+    def wrapper(*args):
+        storage_calls = [0, 0]
+        token = request_storage_calls.set(storage_calls)
+        start_time = time.perf_counter()
+
+        error_code = None
+        try:
+            return function(*args)
+        except EndpointError as e:
+            error_code = e.tag
+            raise
+        except Exception:
+            error_code = 'unhandled-error'
+            raise
+        finally:
+            record_request(name, start_time, storage_calls, error_code)
+            request_storage_calls.reset(token)
+
+    return wrapper
+
+def instrument_coroutine(function, name):
+    """ Same as instrument_endpoint() but for the coroutine of an endpoint. """
+
+    @functools.wraps(function)
+    async def wrapper(*args):
+        storage_calls = [0, 0]
+        token = request_storage_calls.set(storage_calls)
+        start_time = time.perf_counter()
+
+        error_code = None
+        try:
+            return await function(*args)
+        except EndpointError as e:
+            error_code = e.tag
+            raise
+        except Exception:
+            error_code = 'unhandled-error'
+            raise
+        finally:
+            record_request(name, start_time, storage_calls, error_code)
+            request_storage_calls.reset(token)
+
+    return wrapper
+
+def record_storage_call(method_name, start_time):
+    storage_latency.get(method_name).observe(time.perf_counter() - start_time)
+
+    storage_calls = request_storage_calls.get()
+    if storage_calls is not None:
+        if method_name in READ_METHODS:
+            storage_calls[0] += 1
+        else:
+            storage_calls[1] += 1
+
+class InstrumentedStorage:
+    """ Record the latency and the number of calls of a storage engine. """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def instrumented_method(*args):
+            start_time = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                record_storage_call(name, start_time)
+
+        # Cache it so it's created only once.
+        setattr(self, name, instrumented_method)
+        return instrumented_method
+
+class AsyncInstrumentedStorage:
+    """ Same as InstrumentedStorage but for async storage engines. """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def instrumented_method(*args):
+            start_time = time.perf_counter()
+            try:
+                return await method(*args)
+            finally:
+                record_storage_call(name, start_time)
+
+        setattr(self, name, instrumented_method)
+        return instrumented_method
+
+def generate_metrics():
+    """ Return the metrics in the Prometheus text format. """
+
+    lines = []
+    metrics = (
+        endpoint_latency, endpoint_errors, requests_rejected, coalesced_calls,
+        request_reads, request_writes, storage_latency
+    )
+    for metric in metrics:
+        lines.extend(metric.to_text())
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Create the username lookup documents of the users created before they were
+# introduced. It can be run while the service is live; the service finds the
+# users without lookup document by their username (and creates their lookup
+# document on their next login). Lookup documents are only created if absent,
+# and when several users share the same username (which could happen with
+# concurrent first logins), the least recently updated one wins (as in the
+# service).
+from google.api_core.exceptions import AlreadyExists
+from firestore_storage import User, username_reference
+
+created_count = 0
+existing_count = 0
+skipped_count = 0
+
+for user_document in User.collection.order('last_updated').fetch():
+    try:
+        username_reference(user_document.username).create({
+            'user_key': user_document.key,
+            'password': user_document.password
+        })
+    except AlreadyExists:
+        # Created by a login of the user since the migration started.
+        lookup = username_reference(user_document.username).get()
+        if lookup.get('user_key') == user_document.key:
+            existing_count += 1
+            continue
+
+        print(f"Skipping user {user_document.id} (username already taken by {lookup.get('user_key')})")
+        skipped_count += 1
+    else:
+        created_count += 1
+
+print(f"{created_count} lookup documents created, {existing_count} already existed ({skipped_count} users skipped)")
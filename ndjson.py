@@ -0,0 +1,72 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Tasks are exported and imported as NDJSON (one JSON object per line) so
+#   they can be streamed; both the export and import endpoints, and the backup
+#   script use the same format.
+# - Each line is a record with a 'type' field; 'task' records have the same
+#   fields as the tasks of the endpoints (along with their ID), and 'user'
+#   records (written by the backup script only) are followed by the records of
+#   the tasks of the user.
+# - Records are serialized with the fast serializer (see serializer.py).
+from datetime import datetime
+from serializer import dumps, loads
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+def dump_record(record):
+    return dumps(record) + '\n'
+
+def load_record(line):
+    return loads(line)
+
+def task_record(task_id, task):
+    return {
+        'type':        'task',
+        'id':          task_id,
+        'name':        task['name'],
+        'description': task['description'],
+        'status':      task['status']
+    }
+
+def user_record(user_id, user):
+    return {
+        'type':         'user',
+        'id':           user_id,
+        'username':     user['username'],
+        'password':     user['password'],
+        'last-updated': user['last_updated'].isoformat()
+    }
+
+def record_to_user(record):
+    return {
+        'username':     record['username'],
+        'password':     record['password'],
+        'last_updated': datetime.fromisoformat(record['last-updated'])
+    }
+
+def record_to_task(record):
+    return {
+        'name':        record['name'],
+        'description': record['description'],
+        'status':      record['status']
+    }
+
+def read_lines(chunks):
+    """ Split a stream of chunks (bytes) into lines (strings), lazily. """
+
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.decode()
+
+    if buffer:
+        yield buffer.decode()
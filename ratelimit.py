@@ -0,0 +1,157 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - Requests are admitted by two limits; a token bucket per client (refilled
+#   at a constant rate, and from which each request takes a number of tokens
+#   depending on the cost of its endpoint) and a maximum number of requests in
+#   flight in the process. Rejected requests are answered immediately, before
+#   their body is even read.
+# - The limit of requests in flight only bites in the async serving mode;
+#   with Gunicorn threads, the requests in excess wait in the queue of the
+#   server, out of sight of the application (at most one request per thread
+#   is ever in flight). Requests are also shed when they waited in a queue
+#   for too long, which is measured with the 'X-Request-Start' header set by
+#   the proxy in front of the service, when there is one. Neither applies to
+#   the deployed mode (Gunicorn on Cloud Run, which doesn't set the header);
+#   there, only the rate limits are enforced here and the overload is shed
+#   by Cloud Run (see README.md).
+# - It's on the hot path of every request; buckets are spread over several
+#   dicts, each with its own lock, so concurrent requests of different clients
+#   rarely wait on each other, and the number of buckets is bounded (the least
+#   recently used are dropped, which is the same as them being full).
+import time
+import threading
+from collections import OrderedDict
+
+STRIPE_COUNT = 16
+MAX_BUCKET_COUNT = 16384
+
+class TokenBuckets:
+    """ Token buckets mapped by key (a user key or a client IP).
+
+    Buckets hold up to 'burst' tokens and are refilled with 'rate' tokens per
+    second.
+    """
+
+    def __init__(self, rate, burst, size=MAX_BUCKET_COUNT, stripe_count=STRIPE_COUNT):
+        self.rate = rate
+        self.burst = burst
+        self.stripe_size = max(size // stripe_count, 1)
+
+        # Buckets are (token count, last update time) tuples.
+        self.stripes = [(threading.Lock(), OrderedDict()) for _ in range(stripe_count)]
+
+    def take(self, key, cost):
+        """ Take a number of tokens from the bucket of a key.
+
+        It returns 0 if the tokens were taken, or the number of seconds after
+        which they will be available otherwise.
+        """
+
+        if self.rate <= 0:
+            return 0.0
+
+        # A request can't cost more than a full bucket.
+        cost = min(cost, self.burst)
+
+        lock, buckets = self.stripes[hash(key) % len(self.stripes)]
+        now = time.monotonic()
+
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens, update_time = bucket
+                tokens = min(self.burst, tokens + (now - update_time) * self.rate)
+                buckets.move_to_end(key)
+
+            if tokens < cost:
+                buckets[key] = (tokens, now)
+                return (cost - tokens) / self.rate
+
+            buckets[key] = (tokens - cost, now)
+            if len(buckets) > self.stripe_size:
+                buckets.popitem(last=False)
+
+        return 0.0
+
+class InFlightLimiter:
+    """ Limit the number of requests processed concurrently (0 for no limit). """
+
+    def __init__(self, limit):
+        self.semaphore = None
+        if limit > 0:
+            self.semaphore = threading.BoundedSemaphore(limit)
+
+    def enter(self):
+        """ Return whether the request can be processed, without waiting. """
+
+        if self.semaphore is None:
+            return True
+
+        return self.semaphore.acquire(blocking=False)
+
+    def leave(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+def queue_time(request_start, now=None):
+    """ Return how long a request waited (in seconds) since its
+    'X-Request-Start' header, or None if it's missing or invalid.
+
+    The header is 't=' followed by a timestamp in seconds, milliseconds or
+    microseconds (depending on the proxy).
+    """
+
+    if not request_start:
+        return None
+
+    try:
+        start_time = float(request_start.strip().removeprefix('t='))
+    except ValueError:
+        return None
+
+    if start_time > 1e14:
+        start_time /= 1e6
+    elif start_time > 1e11:
+        start_time /= 1e3
+
+    if now is None:
+        now = time.time()
+
+    return max(now - start_time, 0.0)
+
+def route_name(path):
+    """ Return the name of the endpoint of a path (without the item ID). """
+
+    parts = path.strip('/').split('/')
+    if len(parts) == 3:
+        return parts[0] + '/' + parts[2]
+
+    return '/'.join(parts)
+
+def client_ip(forwarded_for, remote_address, proxy_count=1):
+    """ Return the IP address of the client of a request.
+
+    The leftmost forwarded addresses are written by the client (and can be
+    anything); only the addresses appended by the trusted proxies in front of
+    the service are used, the client being the one appended by the farthest
+    of them ('proxy_count' addresses from the right). Without trusted proxy
+    (or forwarded address), it's the address of the connection.
+    """
+
+    if proxy_count <= 0 or not forwarded_for:
+        return remote_address
+
+    addresses = [address.strip() for address in forwarded_for.split(',')]
+    if len(addresses) < proxy_count:
+        return remote_address
+
+    return addresses[-proxy_count]
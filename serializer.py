@@ -0,0 +1,42 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - JSON documents serialized by the service itself (the NDJSON records of the
+#   export and import of tasks, the documents of the plain routes, etc.) go
+#   through this module; it uses orjson when it's installed (several times
+#   faster than the standard library, and compact) and falls back to the
+#   'json' module otherwise.
+# - In the Flask serving mode, the documents of the endpoints are serialized
+#   by the Endpoints library (along with their validation) with the standard
+#   library; this module doesn't apply to them. The async serving mode
+#   serializes them with this module. See bench_serialization.py.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NAME = 'orjson' if orjson is not None else 'json'
+
+def dumps(value):
+    """ Serialize a value to a (compact) JSON string. """
+
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+
+    return json.dumps(value, separators=(',', ':'))
+
+def loads(data):
+    """ Deserialize a JSON string (or bytes). """
+
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
@@ -0,0 +1,89 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - The session of a user (the time before its data are wiped by the cleaning
+#   job, see clean_tasks.py) is extended by its activity; the 'last_updated'
+#   field of the user is moved forward when it uses the service.
+# - Writing it on every request would double the number of writes; instead,
+#   the activity is recorded in memory (a set of user keys) and written
+#   behind by a background thread, at the end of each interval, with batched
+#   writes. A user is written at most once per interval, however many
+#   requests it made.
+# - Pending activity is written when the process exits, and it's kept for
+#   the next interval if the write fails.
+import logging
+import threading
+from datetime import datetime
+from logs import setup_logging, log
+
+logger = setup_logging('task_tracker.sessions')
+
+class ActivityRecorder:
+    """ Record the activity of users and write it behind, every 'interval'
+    seconds (0 to write it immediately).
+    """
+
+    def __init__(self, storage, interval):
+        self.storage = storage
+        self.interval = interval
+
+        self.pending = set()
+        self.lock = threading.Lock()
+
+        # The thread is started on the first recorded activity.
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def record(self, user_key):
+        if self.interval <= 0:
+            self.storage.touch_users([user_key], datetime.now())
+            return
+
+        with self.lock:
+            self.pending.add(user_key)
+
+            if self.thread is None and not self.stopped.is_set():
+                self.thread = threading.Thread(target=self.run, name='activity-flusher', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        """ Write the pending activity; it returns the number of users. """
+
+        with self.lock:
+            user_keys, self.pending = self.pending, set()
+
+        if not user_keys:
+            return 0
+
+        try:
+            self.storage.touch_users(sorted(user_keys), datetime.now())
+        except Exception:
+            logger.exception("Writing the activity of users failed")
+
+            with self.lock:
+                self.pending |= user_keys
+
+            return 0
+
+        log(logger, logging.DEBUG, "Activity of users written", user_count=len(user_keys))
+        return len(user_keys)
+
+    def stop(self):
+        """ Stop the background thread, and write the pending activity. """
+
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.flush()
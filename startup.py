@@ -0,0 +1,90 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - This is the entry point of the service on Cloud Run, where every cold start
+#   delays the requests waiting for the new instance.
+# - The heavy dependencies (the Firestore client stack and PyJWT) are not
+#   imported by the service itself at startup; they're imported (and the
+#   Firestore client is created) in a background thread once the application
+#   is returned to Gunicorn, so the worker starts accepting requests without
+#   waiting for them. A request arriving before the warm up has completed
+#   simply waits for it (or does it itself).
+# - The specs of the endpoints are generated once, when the application is
+#   created.
+# - The duration of each phase of the startup is logged.
+#
+# To start the server (with Gunicorn):
+#
+#   gunicorn --bind :8000 --workers 1 --threads 8 'startup:with_unicorn()'
+#
+import time
+import logging
+import threading
+
+start_time = time.perf_counter()
+
+from logs import setup_logging, log
+from storage import LazyStorage
+
+logger = setup_logging('task_tracker.startup')
+
+# Duration (in seconds) of the phases of the startup, in order.
+phases = {}
+
+def record_phase(name, start_time):
+    end_time = time.perf_counter()
+    phases[name] = end_time - start_time
+
+    return end_time
+
+def warm_up(storage):
+    phase_start_time = time.perf_counter()
+
+    # Only imported so the first token doesn't wait for it.
+    import jwt
+    phase_start_time = record_phase('import-jwt', phase_start_time)
+
+    storage.load()
+    phase_start_time = record_phase('import-storage', phase_start_time)
+
+    try:
+        storage.load().warm_up()
+    except Exception:
+        # Not fatal; requests will fail (and report it) if it persists.
+        logger.exception("Storage warm up failed")
+    record_phase('warm-up-storage', phase_start_time)
+
+    log_phases("Warm up completed")
+
+def log_phases(message):
+    durations = {name + '-ms': round(duration * 1000, 1) for name, duration in phases.items()}
+    log(logger, logging.INFO, message, **durations)
+
+def with_unicorn():
+    phase_start_time = record_phase('import-logs', start_time)
+
+    import task_tracker
+    phase_start_time = record_phase('import-service', phase_start_time)
+
+    # Generate the specs, and add the routes.
+    flask = task_tracker.with_unicorn()
+    record_phase('build-endpoints', phase_start_time)
+
+    log_phases("Application created")
+
+    # The storage engine is wrapped by the instrumentation (and possibly by a
+    # simulated latency).
+    storage = task_tracker.storage
+    while not isinstance(storage, LazyStorage):
+        storage = storage.storage
+
+    thread = threading.Thread(target=warm_up, args=(storage,), name='warm-up', daemon=True)
+    thread.start()
+
+    return flask
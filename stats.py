@@ -0,0 +1,120 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - The number of users and tasks are maintained in sharded counter documents
+#   (one document per shard in the 'stats' collection) so that reading them
+#   costs a constant number of reads, regardless of the size of the database.
+# - Each mutation increments one random shard to avoid contention on a single
+#   document (Firestore sustains roughly one write per second per document).
+# - Counters must be incremented in the same batch (or transaction) as the
+#   mutation itself, otherwise they may drift; run this file as a script to
+#   rebuild them from a full scan if it ever happens.
+# - The rebuild overwrites the counters (and the task count of each user)
+#   without a transaction; increments made by the service during the scan are
+#   lost, so it must only run while the service is idle (no traffic, or
+#   scaled to zero).
+import random
+import fireo
+from fireo import db
+
+STATS_COLLECTION = "stats"
+STATS_SHARD_COUNT = 10
+
+def shard_reference(index, client=None):
+    if client is None:
+        client = db.conn
+
+    return client.collection(STATS_COLLECTION).document(str(index))
+
+def increment_counters(user_delta=0, task_delta=0, writer=None, client=None):
+    """ Increment the user and task counters.
+
+    The writer is a Firestore batch or transaction the increment is added to;
+    if none is given, the increment is written immediately. The client defaults
+    to the one of Fireo (pass the async client along with an async writer).
+    """
+
+    fields = {}
+    if user_delta:
+        fields['user_count'] = fireo.Increment(user_delta)
+    if task_delta:
+        fields['task_count'] = fireo.Increment(task_delta)
+
+    if not fields:
+        return
+
+    shard = shard_reference(random.randrange(STATS_SHARD_COUNT), client)
+    if writer is None:
+        shard.set(fields, merge=True)
+    else:
+        writer.set(shard, fields, merge=True)
+
+def read_counters():
+    """ Read the user and task counters.
+
+    It returns a (user count, task count) tuple; all shards are read in a
+    single batched read.
+    """
+
+    shards = [shard_reference(index) for index in range(STATS_SHARD_COUNT)]
+    return sum_counters(db.conn.get_all(shards))
+
+def sum_counters(snapshots):
+    user_count = 0
+    task_count = 0
+
+    for snapshot in snapshots:
+        if not snapshot.exists:
+            continue
+
+        values = snapshot.to_dict()
+        user_count += values.get('user_count', 0)
+        task_count += values.get('task_count', 0)
+
+    return user_count, task_count
+
+def reconcile():
+    """ Rebuild the counters from a full scan of the database.
+
+    The task count of each user is rebuilt as well. Only tasks of existing
+    users are counted (tasks left behind by deleted users are ignored). The
+    values are overwritten, so it must run while the service is idle.
+    """
+
+    user_count = 0
+    task_count = 0
+
+    users = db.conn.collection("users")
+    for user_snapshot in users.select([]).stream():
+        tasks = user_snapshot.reference.collection("tasks")
+
+        user_task_count = 0
+        for _ in tasks.select([]).stream():
+            user_task_count += 1
+
+        user_snapshot.reference.update({'task_count': user_task_count})
+
+        task_count += user_task_count
+        user_count += 1
+
+    batch = fireo.batch()
+    for index in range(STATS_SHARD_COUNT):
+        if index == 0:
+            values = {'user_count': user_count, 'task_count': task_count}
+        else:
+            values = {'user_count': 0, 'task_count': 0}
+
+        batch.set(shard_reference(index), values)
+    batch.commit()
+
+    return user_count, task_count
+
+if __name__ == "__main__":
+    user_count, task_count = reconcile()
+    print(f"Counters rebuilt ({user_count} users and {task_count} tasks)")
@@ -0,0 +1,610 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - The endpoints don't talk to the database directly but to a storage engine
+#   which is selected at startup. The 'firestore' engine is the production one,
+#   and the 'memory' engine keeps everything in the process (for load tests,
+#   benchmarks and running the service without GCP credentials).
+# - Both engines use the same key layout; users are identified by
+#   'users/{user-id}' keys and tasks live under 'users/{user-id}/tasks/{task-id}'.
+# - Users are also addressable by username; the 'usernames' collection holds a
+#   lookup document per username (with the user key and password) which is
+#   created in the same transaction as the user.
+# - Users and tasks are returned as plain dicts (the 'key' field is included
+#   for users), and a missing user or task is returned as None.
+# - The number of tasks of each user is maintained along with the user (in
+#   the same transaction as the creation or deletion of the tasks) so the
+#   maximum number of tasks per user is enforced with a single read.
+# - Likewise, each user has a task version which is changed by every
+#   mutation of its tasks, so clients can tell whether the tasks have changed
+#   with a single read. Versions are the times of the changes (in microseconds
+#   since the epoch; the commit times with Firestore) so they can be written
+#   without reading the previous one, and so changes can be expired by age.
+# - The changes of the tasks (the tombstones of deleted tasks) are only kept
+#   for CHANGES_RETENTION; the changes after an older version are not all
+#   known anymore (see changes_horizon()).
+# - Tasks are changed along with their user (task count and version); if the
+#   user doesn't exist (anymore, it may have been deleted by the cleaning job
+#   while its token is still valid), nothing is written and UserNotFound is
+#   raised.
+# - The Firestore engine lives in firestore_storage.py; it's imported only when
+#   the engine is created because the Firestore client stack (Fireo and the
+#   Google Cloud libraries) is slow to import, which adds to the cold starts.
+import time
+import random
+import string
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+DEFAULT_PAGE_SIZE = 100
+
+# Maximum number of writes in a single Firestore batched write.
+FIRESTORE_BATCH_SIZE = 500
+
+CHANGES_RETENTION = timedelta(hours=1)
+
+VERSION_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+class UserNotFound(Exception):
+    """ The user of the tasks doesn't exist. """
+    pass
+
+class Storage:
+    def get_or_create_user(self, username, password):
+        """ Return the user with the given username, creating it if needed.
+
+        It returns the user (its key and password only) and whether it was
+        created.
+        """
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        """ Return the user with the given ID (along with its task count). """
+        raise NotImplementedError
+
+    def touch_users(self, user_keys, last_updated):
+        """ Set the last update time of users (deleted users are skipped). """
+        raise NotImplementedError
+
+    def list_user_ids(self, limit, cursor):
+        """ Return a page of user IDs, ordered by ID. """
+        raise NotImplementedError
+
+    def create_task(self, user_key, name, description, status, max_task_count):
+        """ Create a task and return its ID.
+
+        It returns None (and creates nothing) if the user would have more than
+        the given number of tasks, and raises UserNotFound if the user doesn't
+        exist.
+        """
+        raise NotImplementedError
+
+    def create_tasks(self, user_key, tasks, max_task_count):
+        """ Create several tasks at once and return their IDs (in order).
+
+        Same as create_task(); either all tasks are created or none.
+        """
+        raise NotImplementedError
+
+    def get_task(self, user_key, task_id):
+        """ Return the task with the given ID. """
+        raise NotImplementedError
+
+    def get_tasks(self, user_key, task_ids):
+        """ Return the existing tasks among the given IDs, mapped by ID. """
+        raise NotImplementedError
+
+    def update_task(self, user_key, task_id, fields):
+        """ Update the given fields of a task; return False if it doesn't exist. """
+        raise NotImplementedError
+
+    def delete_task(self, user_key, task_id):
+        """ Delete a task; return False if it doesn't exist. """
+        raise NotImplementedError
+
+    def delete_tasks(self, user_key, task_ids):
+        """ Delete several tasks at once and return the IDs of the deleted ones. """
+        raise NotImplementedError
+
+    def list_task_ids(self, user_key, limit, cursor, status=None):
+        """ Return a page of task IDs of a user, ordered by ID.
+
+        If a status is given, only the tasks in that status are listed.
+        """
+        raise NotImplementedError
+
+    def iterate_tasks(self, user_key, page_size):
+        """ Yield the (ID, task) tuples of all tasks of a user, ordered by ID.
+
+        Tasks are read one page at a time, so only a page is held in memory.
+        """
+        raise NotImplementedError
+
+    def mark_all_tasks_as(self, user_key, status):
+        """ Change the status of all tasks of a user. """
+        raise NotImplementedError
+
+    def count_tasks(self, user_key, statuses):
+        """ Return the number of tasks of a user, mapped by status.
+
+        Only the given statuses are counted (without reading the tasks).
+        """
+        raise NotImplementedError
+
+    def get_task_version(self, user_key):
+        """ Return the task version of a user (0 if it doesn't exist). """
+        raise NotImplementedError
+
+    def list_task_changes(self, user_key, version):
+        """ Return the tasks changed, and the IDs of the tasks deleted, after a
+        task version of a user.
+
+        The changed tasks are mapped by ID. With version 0, all tasks are
+        returned (and no deleted task). Tasks deleted before the horizon (see
+        changes_horizon()) may be missing.
+        """
+        raise NotImplementedError
+
+    def watch_task_version(self, user_key, callback):
+        """ Call a callback with the task version of a user when it changes.
+
+        The callback may be called from another thread (and must not block);
+        it returns a function to stop watching.
+        """
+        raise NotImplementedError
+
+    def read_counters(self):
+        """ Return the number of users and the number of tasks. """
+        raise NotImplementedError
+
+    def warm_up(self):
+        """ Prepare the engine for its first use (client, connections, etc.). """
+        pass
+
+# Username can't be used as document IDs as is ('..' and '__foo__' are valid
+# usernames but not valid IDs).
+def username_to_id(username):
+    return '@' + username
+
+def snapshot_to_task(snapshot):
+    values = snapshot.to_dict()
+    return {
+        'name':        values['name'],
+        'description': values.get('description'),
+        'status':      values['status']
+    }
+
+def snapshot_to_task_version(snapshot):
+    if not snapshot.exists:
+        return 0
+
+    return time_to_version((snapshot.to_dict() or {}).get('task_version', 0))
+
+# Versions written before they were times are numbers (counters); they're
+# older than any time (Firestore orders numbers before timestamps) and older
+# than the horizon, so clients with one of them start over.
+def time_to_version(value):
+    if not isinstance(value, datetime):
+        return value
+
+    return (value - VERSION_EPOCH) // timedelta(microseconds=1)
+
+def version_to_time(version):
+    return VERSION_EPOCH + timedelta(microseconds=version)
+
+def changes_horizon():
+    """ Return the oldest version whose following changes are all known. """
+    return time_to_version(datetime.now(timezone.utc) - CHANGES_RETENTION)
+
+def lookup_to_user(snapshot):
+    values = snapshot.to_dict()
+    return {
+        'key':      values['user_key'],
+        'password': values['password']
+    }
+
+# Users created before the task count was maintained don't have it; it reads
+# as 0 (so their existing tasks are not counted against the maximum) until it's
+# rebuilt by stats.py. They're not deleted by the cleaning job as long as
+# they're active, so it must be run when that version is deployed (see
+# README.md).
+def snapshot_to_task_count(snapshot):
+    if not snapshot.exists:
+        return 0
+
+    return (snapshot.to_dict() or {}).get('task_count', 0)
+
+# Users created before the lookup documents were introduced are found by
+# their username (see migrate_usernames.py); if several users share it, the
+# least recently updated one wins, as in the migration.
+def legacy_snapshots_to_user(snapshots):
+    snapshots = [snapshot for snapshot in snapshots if snapshot.exists]
+    if not snapshots:
+        return None
+
+    snapshot = min(snapshots, key=lambda snapshot: snapshot.get('last_updated'))
+    return {
+        'key':      'users/' + snapshot.id,
+        'password': snapshot.get('password')
+    }
+
+def generate_id():
+    # Same format as the IDs generated by Firestore.
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+
+def page_ids(ids, limit, cursor):
+    ids = sorted(ids)
+
+    if cursor:
+        ids = [id for id in ids if id > cursor]
+
+    if not limit:
+        limit = DEFAULT_PAGE_SIZE
+
+    return ids[:limit]
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        # Users are mapped by key (and user keys by username), and tasks are
+        # mapped by user key then by ID. Task versions, changes (the version
+        # of the last change of each task and whether it was deleted, mapped
+        # by task ID), tombstones (the version and ID of the deleted tasks, in
+        # order, to prune them) and watch callbacks are mapped by user key.
+        #
+        # The counters (and the task count of each user) are maintained along
+        # with each mutation, like the Firestore engine does, rather than
+        # computed; so they can be checked against the tasks (see
+        # test_counters.py).
+        self.users = {}
+        self.usernames = {}
+        self.tasks = {}
+        self.task_versions = {}
+        self.task_changes = {}
+        self.tombstones = {}
+        self.watch_callbacks = {}
+
+        self.user_count = 0
+        self.task_count = 0
+
+        self.lock = threading.Lock()
+
+    def get_or_create_user(self, username, password):
+        with self.lock:
+            user_key = self.usernames.get(username)
+            if user_key is not None:
+                user = self.users[user_key]
+                return {'key': user_key, 'password': user['password']}, False
+
+            user_key = 'users/' + generate_id()
+            self.users[user_key] = {
+                'key':          user_key,
+                'username':     username,
+                'password':     password,
+                'last_updated': datetime.now(),
+                'task_count':   0
+            }
+            self.usernames[username] = user_key
+            self.tasks[user_key] = {}
+            self.user_count += 1
+
+        return {'key': user_key, 'password': password}, True
+
+    def get_user(self, user_id):
+        with self.lock:
+            user = self.users.get('users/' + user_id)
+            if user is None:
+                return None
+
+            return dict(user)
+
+    def touch_users(self, user_keys, last_updated):
+        with self.lock:
+            for user_key in user_keys:
+                user = self.users.get(user_key)
+                if user is not None:
+                    user['last_updated'] = last_updated
+
+    def list_user_ids(self, limit, cursor):
+        with self.lock:
+            user_ids = [key.split('/')[1] for key in self.users]
+
+        return page_ids(user_ids, limit, cursor)
+
+    def create_task(self, user_key, name, description, status, max_task_count):
+        task_id = generate_id()
+
+        with self.lock:
+            self.check_user(user_key)
+
+            tasks = self.tasks[user_key]
+            if self.users[user_key]['task_count'] + 1 > max_task_count:
+                return None
+
+            tasks[task_id] = {
+                'name':        name,
+                'description': description,
+                'status':      status
+            }
+            self.increment_task_count(user_key, 1)
+            self.increment_task_version(user_key, [task_id])
+
+        return task_id
+
+    def create_tasks(self, user_key, tasks, max_task_count):
+        task_ids = [generate_id() for _ in tasks]
+
+        with self.lock:
+            self.check_user(user_key)
+
+            user_tasks = self.tasks[user_key]
+            if self.users[user_key]['task_count'] + len(tasks) > max_task_count:
+                return None
+
+            for task_id, task in zip(task_ids, tasks):
+                user_tasks[task_id] = {
+                    'name':        task['name'],
+                    'description': task['description'],
+                    'status':      task['status']
+                }
+            self.increment_task_count(user_key, len(tasks))
+            self.increment_task_version(user_key, task_ids)
+
+        return task_ids
+
+    def get_task(self, user_key, task_id):
+        with self.lock:
+            task = self.tasks.get(user_key, {}).get(task_id)
+            if task is None:
+                return None
+
+            return dict(task)
+
+    def get_tasks(self, user_key, task_ids):
+        tasks = {}
+
+        with self.lock:
+            user_tasks = self.tasks.get(user_key, {})
+            for task_id in task_ids:
+                task = user_tasks.get(task_id)
+                if task is not None:
+                    tasks[task_id] = dict(task)
+
+        return tasks
+
+    def update_task(self, user_key, task_id, fields):
+        with self.lock:
+            self.check_user(user_key)
+
+            task = self.tasks.get(user_key, {}).get(task_id)
+            if task is None:
+                return False
+
+            if fields:
+                task.update(fields)
+                self.increment_task_version(user_key, [task_id])
+
+        return True
+
+    def delete_task(self, user_key, task_id):
+        with self.lock:
+            self.check_user(user_key)
+
+            tasks = self.tasks.get(user_key, {})
+            if tasks.pop(task_id, None) is None:
+                return False
+
+            self.increment_task_count(user_key, -1)
+            self.increment_task_version(user_key, [task_id], deleted=True)
+
+        return True
+
+    def delete_tasks(self, user_key, task_ids):
+        deleted_ids = set()
+
+        with self.lock:
+            self.check_user(user_key)
+
+            tasks = self.tasks.get(user_key, {})
+            for task_id in task_ids:
+                if tasks.pop(task_id, None) is not None:
+                    deleted_ids.add(task_id)
+
+            if deleted_ids:
+                self.increment_task_count(user_key, -len(deleted_ids))
+                self.increment_task_version(user_key, deleted_ids, deleted=True)
+
+        return deleted_ids
+
+    def list_task_ids(self, user_key, limit, cursor, status=None):
+        with self.lock:
+            tasks = self.tasks.get(user_key, {})
+            task_ids = [task_id for task_id, task in tasks.items() if status in (None, task['status'])]
+
+        return page_ids(task_ids, limit, cursor)
+
+    def iterate_tasks(self, user_key, page_size):
+        cursor = None
+        while True:
+            with self.lock:
+                tasks = self.tasks.get(user_key, {})
+                page = [(task_id, dict(tasks[task_id])) for task_id in page_ids(tasks, page_size, cursor)]
+
+            yield from page
+
+            if len(page) < page_size:
+                return
+
+            cursor = page[-1][0]
+
+    def mark_all_tasks_as(self, user_key, status):
+        with self.lock:
+            self.check_user(user_key)
+
+            task_ids = []
+            for task_id, task in self.tasks.get(user_key, {}).items():
+                if task['status'] != status:
+                    task['status'] = status
+                    task_ids.append(task_id)
+
+            if task_ids:
+                self.increment_task_version(user_key, task_ids)
+
+    def check_user(self, user_key):
+        # The lock must be held.
+        if user_key not in self.users:
+            raise UserNotFound(user_key)
+
+    def increment_task_count(self, user_key, delta):
+        # The lock must be held.
+        self.users[user_key]['task_count'] += delta
+        self.task_count += delta
+
+    def increment_task_version(self, user_key, task_ids, deleted=False):
+        # The lock must be held. The version is the current time, unless the
+        # clock didn't move since the previous change (or went backward).
+        now = time_to_version(datetime.now(timezone.utc))
+        version = max(self.task_versions.get(user_key, 0) + 1, now)
+        self.task_versions[user_key] = version
+
+        changes = self.task_changes.setdefault(user_key, {})
+        for task_id in task_ids:
+            changes[task_id] = (version, deleted)
+
+        tombstones = self.tombstones.setdefault(user_key, deque())
+        if deleted:
+            tombstones.extend((version, task_id) for task_id in task_ids)
+
+        # Tombstones beyond the retention are pruned (unless the task ID was
+        # changed again since).
+        horizon = changes_horizon()
+        while tombstones and tombstones[0][0] < horizon:
+            tombstone_version, task_id = tombstones.popleft()
+            if changes.get(task_id) == (tombstone_version, True):
+                del changes[task_id]
+
+        for callback in self.watch_callbacks.get(user_key, []):
+            callback(version)
+
+    def count_tasks(self, user_key, statuses):
+        counts = dict.fromkeys(statuses, 0)
+
+        with self.lock:
+            for task in self.tasks.get(user_key, {}).values():
+                if task['status'] in counts:
+                    counts[task['status']] += 1
+
+        return counts
+
+    def get_task_version(self, user_key):
+        with self.lock:
+            return self.task_versions.get(user_key, 0)
+
+    def list_task_changes(self, user_key, version):
+        changed_tasks = {}
+        deleted_ids = []
+
+        with self.lock:
+            tasks = self.tasks.get(user_key, {})
+            if version == 0:
+                return {task_id: dict(task) for task_id, task in tasks.items()}, []
+
+            for task_id, (task_version, deleted) in self.task_changes.get(user_key, {}).items():
+                if task_version <= version:
+                    continue
+
+                if deleted:
+                    deleted_ids.append(task_id)
+                else:
+                    changed_tasks[task_id] = dict(tasks[task_id])
+
+        return changed_tasks, deleted_ids
+
+    def watch_task_version(self, user_key, callback):
+        with self.lock:
+            self.watch_callbacks.setdefault(user_key, []).append(callback)
+
+        def unsubscribe():
+            with self.lock:
+                callbacks = self.watch_callbacks[user_key]
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self.watch_callbacks[user_key]
+
+        return unsubscribe
+
+    def read_counters(self):
+        with self.lock:
+            return self.user_count, self.task_count
+
+class DelayedStorage:
+    """ Add a delay to each call of a storage engine.
+
+    It's used to simulate the round trips to a remote database with the memory
+    engine in benchmarks.
+    """
+
+    def __init__(self, storage, latency):
+        self.storage = storage
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        def delayed_method(*args):
+            time.sleep(self.latency)
+            return method(*args)
+
+        return delayed_method
+
+class LazyStorage:
+    """ Create a storage engine on its first use.
+
+    It defers the import of the engine dependencies (and the creation of its
+    client) out of the startup of the server; call load() to create it ahead
+    of time (from a background thread, for instance).
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.storage = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.storage is None:
+            with self.lock:
+                if self.storage is None:
+                    self.storage = storage_engines[self.engine]()
+
+        return self.storage
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+def make_firestore_storage():
+    from firestore_storage import FirestoreStorage
+    return FirestoreStorage()
+
+storage_engines = {
+    'firestore': make_firestore_storage,
+    'memory':    MemoryStorage
+}
+
+def make_storage(engine, latency=0.0, lazy=False):
+    assert engine in storage_engines, f"unknown storage engine '{engine}'"
+
+    if lazy:
+        storage = LazyStorage(engine)
+    else:
+        storage = storage_engines[engine]()
+
+    if latency > 0:
+        storage = DelayedStorage(storage, latency)
+
+    return storage
@@ -18,27 +18,134 @@
 # TODO; Improve last-updated field to be either a record (restricting to
 #       date time in ISO format) or to be of the 'datetime' field later when
 #       it's implemented (and if) in the Document Validator standard.
-from datetime import datetime
+import io
+import os
 import re
-import jwt
-from fireo.models import Model
-from fireo.fields import TextField, DateTime
+import math
+import time
+import atexit
+import hashlib
+import logging
+import contextvars
+import flask
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from byteplug.document import Node
+from byteplug.document.document import document_to_object
 from byteplug.endpoints import Endpoints
 from byteplug.endpoints import request, response, error
 from byteplug.endpoints import endpoint, collection_endpoint
 from byteplug.endpoints import adaptor
 from byteplug.endpoints import EndpointError
+from storage import UserNotFound, make_storage, changes_horizon
+from cache import LRUCache
+from coalesce import coalesce_endpoint
+from sessions import ActivityRecorder
+from changes import ThreadTaskVersionWatches
+from compression import choose_encoding, is_compressible, compress
+import serializer
+from metrics import instrument_endpoint, InstrumentedStorage, generate_metrics, requests_rejected
+from ratelimit import TokenBuckets, InFlightLimiter, route_name, client_ip, queue_time
+from ndjson import CONTENT_TYPE, dump_record, task_record, record_to_task, read_lines
+from logs import setup_logging, log
 
 JWT_ALGORITHM = "HS256"
 JWT_SECRET = "CVuyY1Se"
 
+# Verified tokens are cached (mapped to their user key) so their signature is
+# not checked again on each request.
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", 300))
+
+# Tasks are cached (mapped to their key) by the get task endpoint, and the
+# cached tasks are invalidated by the endpoints modifying them.
+TASK_CACHE_SIZE = int(os.environ.get("TASK_CACHE_SIZE", 4096))
+TASK_CACHE_TTL = int(os.environ.get("TASK_CACHE_TTL", 60))
+
+# Concurrent identical calls of the global read endpoints (status and list
+# users) are coalesced, and their results are reused for a short window (in
+# milliseconds, 0 to only coalesce concurrent calls); see coalesce.py.
+COALESCE_WINDOW = int(os.environ.get("COALESCE_WINDOW", 250))
+COALESCED_ENDPOINTS = ('status', 'list_users')
+
 SESSION_DURATION = "60 minutes"
+
+# Sessions are extended by the activity of users; it's written behind, at
+# most once per user every given number of seconds (see sessions.py).
+SESSION_FLUSH_INTERVAL = int(os.environ.get("SESSION_FLUSH_INTERVAL", 60))
 MAX_TASK_PER_USER = 100
 
 TASK_STATUS = ('not-done', 'in-progress', 'done')
 
+MAX_PAGE_SIZE = 1000
+
+# Tasks are exported page by page, and imported in batches (see the export and
+# import endpoints).
+EXPORT_PAGE_SIZE = 100
+IMPORT_BATCH_SIZE = 100
+IMPORT_CHUNK_SIZE = 65536
+
+# Either 'firestore' or 'memory' (see storage.py). An extra latency (in
+# milliseconds) can be added to each storage call to simulate the round trips
+# to the database with the memory engine.
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "firestore")
+STORAGE_LATENCY = int(os.environ.get("STORAGE_LATENCY", 0))
+
+# Requests are admitted by a token bucket per user (or per client IP if it's
+# not authenticated) refilled with RATE_LIMIT tokens per second up to
+# RATE_LIMIT_BURST tokens, by a maximum number of requests in flight (only
+# effective in the async serving mode), and by a maximum time waited in a
+# queue in seconds (only effective behind a proxy setting the
+# 'X-Request-Start' header); see ratelimit.py. Use 0 to disable them.
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", 20))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 60))
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 64))
+MAX_QUEUE_TIME = float(os.environ.get("MAX_QUEUE_TIME", 5))
+
+# Number of trusted proxies appending to the 'X-Forwarded-For' header in front
+# of the service (1 on Cloud Run); see client_ip().
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", 1))
+
+# Number of tokens taken by the requests of the most expensive endpoints (the
+# other endpoints take a single token).
+ENDPOINT_COSTS = {
+    'status':            5,
+    'users/list':        2,
+    'tasks/create-many': 5,
+    'tasks/get-many':    2,
+    'tasks/delete-many': 5,
+    'tasks/list':        2,
+    'tasks/count':       3,
+    'tasks/mark-all-as': 10,
+    'tasks/export':      10,
+    'tasks/import':      10
+}
+
+# The request documents of these endpoints were added after them (clients
+# call them without a body), or are made of optional fields only; the
+# document can be omitted, and so can any of its fields. The Endpoints library
+# requires both, so the omitted ones are filled with null before the document
+# is validated (see fill_optional_fields()). Fields are listed in the order of
+# their specs.
+OPTIONAL_FIELDS = {
+    'users/list': ('limit', 'cursor'),
+    'tasks/list': ('limit', 'cursor', 'status'),
+    'tasks/changes': ('version', 'timeout')
+}
+
+# Requests of the change feed wait (up to the given number of seconds) for
+# the tasks to change (see changes.py); they're not counted in the requests in
+# flight. In the async serving mode, they wait without a thread. In the Flask
+# mode, each holds a thread while it waits, so at most MAX_LONG_POLLS of them
+# are admitted at once (the others are rejected with a 429 status code).
+MAX_CHANGES_TIMEOUT = 30
+MAX_LONG_POLLS = int(os.environ.get("MAX_LONG_POLLS", 2))
+LONG_POLL_ENDPOINTS = ('tasks/changes',)
+
+# Responses larger than the given number of bytes are compressed (when the
+# client accepts it, see compression.py).
+COMPRESSION_THRESHOLD = int(os.environ.get("COMPRESSION_THRESHOLD", 1024))
+
 # TODO; Update regex to allow more characters.
 USERNAME_PATTERN = "^[a-zA-Z0-9_.-]*$"
 USERNAME_LENGTH = (2, 16)
@@ -46,27 +153,45 @@ USERNAME_LENGTH = (2, 16)
 PASSWORD_PATTERN = "^(?=.*[A-Za-z])(?=.*\d)[A-Za-z\d]{8,}$"
 PASSWORD_LENGTH = (8, 16)
 
+# Document IDs are generated by Firestore (20 alphanumeric characters).
+ID_PATTERN = "^[a-zA-Z0-9]+$"
+
 TASK_NAME_LENGTH = (2, 40)
 TASK_DESCRIPTION_LENGTH = (0, 120)
 
-class User(Model):
-    username = TextField(required=True)
-    password = TextField(required=True)
-    last_updated = DateTime(required=True)
+logger = setup_logging('task_tracker')
+
+# The storage engine is created on first use (see startup.py).
+storage = InstrumentedStorage(make_storage(STORAGE_ENGINE, STORAGE_LATENCY / 1000, lazy=True))
+token_cache = LRUCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+task_cache = LRUCache(TASK_CACHE_SIZE, TASK_CACHE_TTL)
 
-    class Meta:
-        collection_name = "users"
+# The get task, list tasks and status endpoints support conditional requests;
+# they set the ETag of their response, and requests whose 'If-None-Match'
+# header matches the current ETag are answered with a 304 status code before
+# the endpoint is executed. ETags of lists of tasks are derived from the task
+# version of the user (so checking them costs a single read).
+#
+# ETags of the endpoints of the tasks carry a short hash of the user key; task
+# versions of different users collide (all users start at 0), and a client
+# (or a shared cache) switching tokens must not be answered with a 304 for
+# the data of another user. The status endpoint isn't per-user.
+CONDITIONAL_ENDPOINTS = ('tasks/get', 'tasks/list', 'tasks/count', 'status')
+response_etag = contextvars.ContextVar('response_etag', default=None)
+
+activity = ActivityRecorder(storage, SESSION_FLUSH_INTERVAL)
+atexit.register(activity.stop)
 
-class Task(Model):
-    name = TextField(required=True)
-    description = TextField()
-    status = TextField(required=True)
+task_version_watches = ThreadTaskVersionWatches(storage)
 
-    class Meta:
-        collection_name = "tasks"
+token_buckets = TokenBuckets(RATE_LIMIT, RATE_LIMIT_BURST)
+in_flight = InFlightLimiter(MAX_IN_FLIGHT)
+long_polls = InFlightLimiter(MAX_LONG_POLLS)
 
 endpoints = Endpoints('task-tracker')
-flask_cors = CORS(endpoints.flask)
+# Browsers only let scripts read the response headers which are exposed.
+CORS_EXPOSE_HEADERS = ['ETag', 'Retry-After']
+flask_cors = CORS(endpoints.flask, expose_headers=CORS_EXPOSE_HEADERS)
 
 endpoints.title = "Task Tracker"
 endpoints.summary = """\
@@ -86,13 +211,34 @@ endpoints.license = {
 }
 endpoints.version = "1.0.0"
 
+def decode_token(token):
+    user_key = token_cache.get(token)
+
+    if user_key is None:
+        # Imported on first use (it's slow to import, see startup.py).
+        import jwt
+
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        user_key = payload['user-key']
+
+        # The token must not outlive its expiration in the cache.
+        ttl = None
+        if 'exp' in payload:
+            ttl = payload['exp'] - time.time()
+
+        token_cache.set(token, user_key, ttl)
+
+    return user_key
+
 # This is a generic endpoint adaptor that can be copy-pasted.
 def endpoint_adaptor(token=None, item=None, document=None):
     args = []
 
     if token:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        args.append(payload['user-key'])
+        user_key = decode_token(token)
+        activity.record(user_key)
+
+        args.append(user_key)
 
     if item:
         args.append(item)
@@ -105,6 +251,368 @@ def endpoint_adaptor(token=None, item=None, document=None):
 
     return args
 
+# The following helpers are shared with the async serving mode (see
+# task_tracker_asgi.py).
+def authenticate(authorization):
+    """ Return the user key of an 'Authorization' header (None if invalid). """
+
+    parts = authorization.split(' ')
+    if len(parts) != 2 or parts[0] != "Bearer":
+        return None
+
+    try:
+        return decode_token(parts[1])
+    except Exception:
+        return None
+
+def fill_optional_fields(name, body):
+    """ Return the body of a request with the omitted optional fields of its
+    document filled with null (see OPTIONAL_FIELDS).
+
+    An empty body is an empty document; bodies that are not a JSON object are
+    returned as is (the validation of the document rejects them).
+    """
+
+    fields = OPTIONAL_FIELDS.get(name)
+    if fields is None:
+        return body
+
+    if not body.strip():
+        document = {}
+    else:
+        try:
+            document = serializer.loads(body)
+        except ValueError:
+            return body
+
+        if type(document) is not dict:
+            return body
+
+    # The fields are passed to the endpoint by position (see the adaptor), so
+    # they're written in the order of the specs.
+    filled_document = {field: document.get(field) for field in fields} | document
+    return serializer.dumps(filled_document).encode()
+
+def make_rate_limit_key(authorization, ip):
+    # Requests with an invalid token are limited by IP (and the endpoint will
+    # reject the token).
+    return authenticate(authorization) or ip
+
+def admit_request(path, authorization, ip, request_start=None):
+    """ Decide whether a request is processed or rejected.
+
+    It returns None if it's admitted (then release_request() must be called
+    once it's processed), or the number of seconds after which it can be
+    retried otherwise.
+    """
+
+    name = route_name(path)
+
+    # Its client has likely given up already; it's dropped without taking
+    # tokens.
+    waited_time = queue_time(request_start)
+    if MAX_QUEUE_TIME > 0 and waited_time is not None and waited_time > MAX_QUEUE_TIME:
+        requests_rejected.increment(name, 'queued-too-long')
+        return 1.0
+
+    retry_after = token_buckets.take(make_rate_limit_key(authorization, ip), ENDPOINT_COSTS.get(name, 1))
+    if retry_after > 0:
+        requests_rejected.increment(name, 'rate-limited')
+        return retry_after
+
+    if name not in LONG_POLL_ENDPOINTS and not in_flight.enter():
+        requests_rejected.increment(name, 'overloaded')
+        return 1.0
+
+    return None
+
+def release_request(path):
+    if route_name(path) not in LONG_POLL_ENDPOINTS:
+        in_flight.leave()
+
+def make_retry_after(retry_after):
+    return str(max(math.ceil(retry_after), 1))
+
+def make_etag(*parts):
+    return '"' + '-'.join(str(part) for part in parts) + '"'
+
+def make_user_tag(user_key):
+    return hashlib.blake2b(user_key.encode(), digest_size=4).hexdigest()
+
+def make_task_etag(user_key, task):
+    values = repr((task['name'], task['description'], task['status'])).encode()
+    return make_etag('task', make_user_tag(user_key), hashlib.blake2b(values, digest_size=8).hexdigest())
+
+def make_tasks_etag(user_key, task_version, limit, cursor, status):
+    return make_etag('tasks', make_user_tag(user_key), task_version, limit or '', cursor or '', status or '')
+
+def make_task_counts_etag(user_key, task_version):
+    return make_etag('task-counts', make_user_tag(user_key), task_version)
+
+def make_status_etag(user_count, task_count):
+    return make_etag('status', user_count, task_count)
+
+def etag_matches(if_none_match, etag):
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags
+
+def read_task(user_key, task_id):
+    """ Return a task (from the task cache if possible), or None. """
+
+    task_key = make_task_key(user_key, task_id)
+
+    task = task_cache.get(task_key)
+    if task is None:
+        # The task is not cached if it's changed (and its cache entry
+        # invalidated) while it's read; it may be the previous value.
+        generation = task_cache.generation
+        task = storage.get_task(user_key, task_id)
+
+        if task is not None:
+            task_cache.set(task_key, task, generation=generation)
+
+    return task
+
+def current_etag(path, user_key, document):
+    """ Return the current ETag of the response of a conditional request.
+
+    It returns None if it can't be determined (the request will be processed
+    as usual).
+    """
+
+    name = route_name(path)
+
+    if name == 'status':
+        return make_status_etag(*storage.read_counters())
+
+    if user_key is None:
+        return None
+
+    if name == 'tasks/get':
+        task = read_task(user_key, path.strip('/').split('/')[1])
+        return make_task_etag(user_key, task) if task is not None else None
+
+    if name == 'tasks/list':
+        if type(document) is not dict:
+            return None
+
+        task_version = storage.get_task_version(user_key)
+        return make_tasks_etag(user_key, task_version, document.get('limit'), document.get('cursor'), document.get('status'))
+
+    if name == 'tasks/count':
+        return make_task_counts_etag(user_key, storage.get_task_version(user_key))
+
+    return None
+
+def make_token(user_key):
+    import jwt
+
+    token = jwt.encode({"user-key": user_key}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    log(logger, logging.DEBUG, "Token generated", sampled=True, user_key=user_key)
+
+    return token
+
+def log_login(username, user_key, created, valid_password):
+    if created:
+        log(logger, logging.INFO, "User created", username=username, user_key=user_key)
+    elif not valid_password:
+        log(logger, logging.INFO, "Invalid password", username=username)
+    else:
+        log(logger, logging.DEBUG, "User logged in", sampled=True, username=username)
+
+def make_task_key(user_key, task_id):
+    return user_key + '/tasks/' + task_id
+
+def make_task_fields(name, description, status):
+    fields = {}
+
+    if name:
+        fields['name'] = name
+
+    if description:
+        fields['description'] = description
+
+    if status:
+        fields['status'] = status
+
+    return fields
+
+def filter_task_ids(task_ids):
+    return [task_id for task_id in task_ids if re.match(ID_PATTERN, task_id)]
+
+def make_new_tasks(tasks):
+    return [{
+        'name':        task['name'],
+        'description': task.get('description'),
+        'status':      task.get('status') or 'not-done'
+    } for task in tasks]
+
+def make_deleted_items(task_ids, deleted_ids):
+    items = []
+    for task_id in task_ids:
+        if task_id in deleted_ids:
+            items.append({'id': task_id, 'error': None})
+        else:
+            items.append({'id': task_id, 'error': 'invalid-task-id'})
+
+    return items
+
+# The changes after a version are listed from where the client is, unless the
+# version is unknown (in the future) or older than the changes still kept (see
+# changes_horizon()); the current version is always fine, nothing changed
+# since. Otherwise the client starts over (version 0).
+def check_task_version(version, current_version):
+    if version > current_version:
+        return 0
+
+    if version < current_version and version < changes_horizon():
+        return 0
+
+    return version
+
+def make_task_changes(version, changed_tasks, deleted_ids, reset):
+    changed = []
+    for task_id, task in sorted(changed_tasks.items()):
+        changed.append({
+            'id':          task_id,
+            'name':        task['name'],
+            'description': task['description'],
+            'status':      task['status']
+        })
+
+    return {
+        'version': version,
+        'reset':   reset,
+        'changed': changed,
+        'deleted': sorted(deleted_ids)
+    }
+
+def make_task_items(task_ids, found_tasks):
+    tasks = []
+    for task_id in task_ids:
+        task = found_tasks.get(task_id)
+
+        if task is None:
+            tasks.append({
+                'id':          task_id,
+                'name':        None,
+                'description': None,
+                'status':      None,
+                'error':       'invalid-task-id'
+            })
+        else:
+            tasks.append({
+                'id':          task_id,
+                'name':        task['name'],
+                'description': task['description'],
+                'status':      task['status'],
+                'error':       None
+            })
+
+    return tasks
+
+def export_tasks(user_key):
+    """ Yield the tasks of a user in the NDJSON format, one chunk per page. """
+
+    lines = []
+    for task_id, task in storage.iterate_tasks(user_key, EXPORT_PAGE_SIZE):
+        lines.append(dump_record(task_record(task_id, task)))
+
+        if len(lines) == EXPORT_PAGE_SIZE:
+            yield ''.join(lines)
+            lines = []
+
+    if lines:
+        yield ''.join(lines)
+
+def create_imported_tasks(user_key, tasks):
+    try:
+        if storage.create_tasks(user_key, tasks, MAX_TASK_PER_USER) is None:
+            return 'too-many-tasks'
+    except UserNotFound:
+        return 'invalid-user-id'
+
+    return None
+
+def import_tasks(user_key, lines):
+    """ Create the tasks read from lines in the NDJSON format.
+
+    Tasks are created in batches as lines are read (and new IDs are given to
+    them). It returns the number of imported tasks along with the error that
+    stopped the import (if any); 'invalid-record' if a line is not a valid
+    task record, 'too-many-tasks' if the user would exceed the maximum
+    number of tasks or 'invalid-user-id' if the user doesn't exist (anymore),
+    with the number of the line.
+    """
+
+    count = 0
+    tasks = []
+
+    line_number = 0
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        errors, warnings = [], []
+        record = document_to_object(line, task_record_node, errors=errors, warnings=warnings)
+        if len(errors) > 0:
+            return count, {'error': 'invalid-record', 'line': line_number}
+
+        tasks.append(record_to_task(record))
+        if len(tasks) < IMPORT_BATCH_SIZE:
+            continue
+
+        error = create_imported_tasks(user_key, tasks)
+        if error is not None:
+            return count, {'error': error, 'line': line_number}
+
+        count += len(tasks)
+        tasks = []
+
+    if tasks:
+        error = create_imported_tasks(user_key, tasks)
+        if error is not None:
+            return count, {'error': error, 'line': line_number}
+
+        count += len(tasks)
+
+    return count, None
+
+def make_cache_stats(cache):
+    stats = cache.stats()
+
+    hit_ratio = 0.0
+    if stats['hits'] + stats['misses'] > 0:
+        hit_ratio = stats['hits'] / (stats['hits'] + stats['misses'])
+
+    return stats | {'hit-ratio': str(hit_ratio)}
+
+def make_status(user_count, task_count):
+    average_task_per_user = 0.0
+    if user_count > 0:
+        average_task_per_user = task_count / user_count
+
+    return {
+        'user-count': user_count,
+        'task-count': task_count,
+        'average-task-per-user': str(average_task_per_user),
+        'session-duration': SESSION_DURATION,
+        'max-task-per-user': MAX_TASK_PER_USER
+    }
+
+task_record_node = Node('map', fields={
+    'type':        Node('enum', values=('task',)),
+    'id':          Node('string', pattern=ID_PATTERN),
+    'name':        Node('string', length=TASK_NAME_LENGTH),
+    'description': Node('string', length=TASK_DESCRIPTION_LENGTH, option=True),
+    'status':      Node('enum', values=TASK_STATUS)
+})
+
+page_request = Node('map', fields={
+    'limit':  Node('number', decimal=False, minimum=1, maximum=MAX_PAGE_SIZE, option=True),
+    'cursor': Node('string', pattern=ID_PATTERN, option=True)
+})
+
 @request(Node('map', fields={
     'username': Node('string', pattern=USERNAME_PATTERN, length=USERNAME_LENGTH),
     'password': Node('string', pattern=PASSWORD_PATTERN, length=PASSWORD_LENGTH)
@@ -121,30 +629,18 @@ def login(username, password):
     doesn't match.
     """
 
-    user_document = User.collection.filter('username', '==', username).get()
-
-    if user_document is None:
-        print("User does not exist, creating it...")
+    user, created = storage.get_or_create_user(username, password)
 
-        user_document = User()
-        user_document.username = username
-        user_document.password = password
-        user_document.last_updated = datetime.now()
-        user_document.save()
+    valid_password = created or user['password'] == password
+    log_login(username, user['key'], created, valid_password)
 
-        user_key = user_document.key
-    else:
-        print("User exists, checking password...")
-        if user_document.password != password:
-            raise EndpointError('invalid-password', None)
-
-        user_key = user_document.key
+    if not valid_password:
+        raise EndpointError('invalid-password', None)
 
-    print("Logging successful, generating token...")
-    token = jwt.encode({"user-key": user_key}, JWT_SECRET, algorithm=JWT_ALGORITHM)
-    print(f"Token {token} was generated")
+    if not created:
+        activity.record(user['key'])
 
-    return token
+    return make_token(user['key'])
 
 @response(Node('map', fields={
     'username': Node('string', pattern=USERNAME_PATTERN, length=USERNAME_LENGTH),
@@ -161,31 +657,30 @@ def get_user(user_id):
     Use the list users endpoints in order to retrieve their IDs.
     """
 
-    user_document = User.collection.get('users/' + user_id)
+    user = storage.get_user(user_id)
 
-    if user_document is None:
+    if user is None:
         raise EndpointError('invalid-user-id')
 
     return {
-        'username': user_document.username,
-        'password': user_document.password,
-        'last-updated': int(user_document.last_updated.timestamp())
+        'username': user['username'],
+        'password': user['password'],
+        'last-updated': int(user['last_updated'].timestamp())
     }
 
+@request(page_request)
 @response(Node('array', value=Node('string')))
 @adaptor(endpoint_adaptor)
 @collection_endpoint("users", "list")
-def list_users():
-    """ List all existing users.
+def list_users(limit, cursor):
+    """ List existing users.
 
-    It returns a list of user IDs. Use the get user endpoint in order to
+    It returns a page of user IDs (100 by default). To retrieve the next page,
+    pass the last returned ID as cursor. Use the get user endpoint in order to
     retrieve their information.
     """
-    users = []
-    for user_document in User.collection.fetch():
-        users.append(user_document.id)
 
-    return users
+    return storage.list_user_ids(limit, cursor)
 
 @request(Node('map', fields={
     'name':        Node('string', length=TASK_NAME_LENGTH),
@@ -193,26 +688,59 @@ def list_users():
     'status':      Node('enum', values=TASK_STATUS, option=True)
 }))
 @response(Node('string'))
+@error('too-many-tasks')
+@error('invalid-user-id')
 @adaptor(endpoint_adaptor)
 @collection_endpoint("tasks", "create", authentication=True)
 def create_task(user_key, name, description, status):
     """ Create a new task.
 
     The newly created task has status 'not-done' unless a specific status is
-    specified. It return the task ID.
+    specified. It return the task ID, or the 'too-many-tasks' error if the user
+    already has the maximum number of tasks.
     """
 
-    task_document = Task(parent=user_key)
-    task_document.name = name
-    task_document.description = description
-
     if not status:
         status = 'not-done'
-    task_document.status = status
 
-    task_document.save()
+    try:
+        task_id = storage.create_task(user_key, name, description, status, MAX_TASK_PER_USER)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    if task_id is None:
+        raise EndpointError('too-many-tasks')
+
+    return task_id
+
+@request(Node('array', value=Node('map', fields={
+    'name':        Node('string', length=TASK_NAME_LENGTH),
+    'description': Node('string', length=TASK_DESCRIPTION_LENGTH, option=True),
+    'status':      Node('enum', values=TASK_STATUS, option=True)
+}), length=(1, MAX_TASK_PER_USER)))
+@response(Node('array', value=Node('string')))
+@error('too-many-tasks')
+@error('invalid-user-id')
+@adaptor(endpoint_adaptor)
+@collection_endpoint("tasks", "create-many", authentication=True)
+def create_many_tasks(user_key, tasks):
+    """ Create several tasks at once.
+
+    Same as the create task endpoint but for several tasks; it returns the IDs
+    of the newly created tasks, in the same order. All tasks are created in a
+    single transaction; none is created if the user would exceed the maximum
+    number of tasks.
+    """
+
+    try:
+        task_ids = storage.create_tasks(user_key, make_new_tasks(tasks), MAX_TASK_PER_USER)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    if task_ids is None:
+        raise EndpointError('too-many-tasks')
 
-    return task_document.id
+    return task_ids
 
 @response(Node('map', fields={
     'name':        Node('string', length=TASK_NAME_LENGTH),
@@ -229,23 +757,46 @@ def get_task(user_key, task_id):
     its ID). Use the list tasks endpoints in order to retrieve their IDs.
     """
 
-    task_document = Task.collection.get(user_key + '/tasks/' + task_id)
-
-    if task_document is None:
+    task = read_task(user_key, task_id)
+    if task is None:
         raise EndpointError('invalid-task-id')
 
+    response_etag.set(make_task_etag(user_key, task))
+
     return {
-        'name':        task_document.name,
-        'description': task_document.description,
-        'status':      task_document.status
+        'name':        task['name'],
+        'description': task['description'],
+        'status':      task['status']
     }
 
+@request(Node('array', value=Node('string'), length=(1, MAX_TASK_PER_USER)))
+@response(Node('array', value=Node('map', fields={
+    'id':          Node('string'),
+    'name':        Node('string', length=TASK_NAME_LENGTH, option=True),
+    'description': Node('string', length=TASK_DESCRIPTION_LENGTH, option=True),
+    'status':      Node('enum', values=TASK_STATUS, option=True),
+    'error':       Node('enum', values=('invalid-task-id',), option=True)
+})))
+@adaptor(endpoint_adaptor)
+@collection_endpoint("tasks", "get-many", authentication=True)
+def get_many_tasks(user_key, task_ids):
+    """ Retrieve the information of several tasks at once.
+
+    It returns the name, description and status of each of the given tasks, in
+    the same order, with the 'invalid-task-id' error set for the tasks that
+    don't exist. All tasks are read in a single batched read.
+    """
+
+    found_tasks = storage.get_tasks(user_key, filter_task_ids(task_ids))
+    return make_task_items(task_ids, found_tasks)
+
 @request(Node('map', fields={
     'name':        Node('string', length=TASK_NAME_LENGTH, option=True),
     'description': Node('string', length=TASK_DESCRIPTION_LENGTH, option=True),
     'status':      Node('enum', values=TASK_STATUS, option=True)
 }))
 @error('invalid-task-id')
+@error('invalid-user-id')
 @adaptor(endpoint_adaptor)
 @collection_endpoint("tasks", "update", operate_on_item=True, authentication=True)
 def update_task(user_key, task_id, name, description, status):
@@ -255,51 +806,148 @@ def update_task(user_key, task_id, name, description, status):
     change a piece of information, use null.
     """
 
-    task_document = Task.collection.get(user_key + '/tasks/' + task_id)
+    fields = make_task_fields(name, description, status)
+
+    try:
+        updated = storage.update_task(user_key, task_id, fields)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
 
-    if task_document is None:
+    if not updated:
         raise EndpointError('invalid-task-id')
 
-    if name:
-        task_document.name = name
+    task_cache.delete(make_task_key(user_key, task_id))
 
-    if description:
-        task_document.description = description
+@error('invalid-task-id')
+@error('invalid-user-id')
+@adaptor(endpoint_adaptor)
+@collection_endpoint("tasks", "delete", operate_on_item=True, authentication=True)
+def delete_task(user_key, task_id):
+    """ Delete a task.
 
-    if status:
-        task_document.status = status
+    It deletes a given task, and returns the 'invalid-task-id' error if it
+    doesn't exist.
+    """
+
+    try:
+        deleted = storage.delete_task(user_key, task_id)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    task_cache.delete(make_task_key(user_key, task_id))
 
-    task_document.save()
+    if not deleted:
+        raise EndpointError('invalid-task-id')
 
-@error('invalid-task-id') # TODO; This one is probably to be removed.
+@request(Node('array', value=Node('string'), length=(1, MAX_TASK_PER_USER)))
+@response(Node('array', value=Node('map', fields={
+    'id':    Node('string'),
+    'error': Node('enum', values=('invalid-task-id',), option=True)
+})))
+@error('invalid-user-id')
 @adaptor(endpoint_adaptor)
-@collection_endpoint("tasks", "delete", operate_on_item=True, authentication=True)
-def delete_task(user_id, task_id):
-    """ Delete a task.
+@collection_endpoint("tasks", "delete-many", authentication=True)
+def delete_many_tasks(user_key, task_ids):
+    """ Delete several tasks at once.
 
-    It simply deletes a given task.
+    It deletes the given tasks and returns, in the same order, the result of
+    each deletion; the 'invalid-task-id' error is set for the tasks that don't
+    exist. All tasks are deleted in a single transaction.
     """
 
-    # TODO; Rework implemention (perhaps to detect invalid task ID ?)
-    Task.collection.delete(user_id + '/tasks/' + task_id)
+    try:
+        deleted_ids = storage.delete_tasks(user_key, filter_task_ids(task_ids))
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    for task_id in deleted_ids:
+        task_cache.delete(make_task_key(user_key, task_id))
 
+    return make_deleted_items(task_ids, deleted_ids)
+
+@request(Node('map', fields={
+    'limit':  Node('number', decimal=False, minimum=1, maximum=MAX_PAGE_SIZE, option=True),
+    'cursor': Node('string', pattern=ID_PATTERN, option=True),
+    'status': Node('enum', values=TASK_STATUS, option=True)
+}))
 @response(Node('array', value=Node('string')))
 @adaptor(endpoint_adaptor)
 @collection_endpoint("tasks", "list", authentication=True)
-def list_tasks(user_key):
-    """ List all existing tasks.
+def list_tasks(user_key, limit, cursor, status):
+    """ List existing tasks.
 
-    It returns a list of IDs of all the tasks for the user.
+    It returns a page of IDs of the tasks for the user (100 by default). To
+    retrieve the next page, pass the last returned ID as cursor. If a status
+    is given, only the tasks in that status are listed.
     """
 
-    tasks = []
+    # The version is read first so the ETag is never newer than the tasks.
+    task_version = storage.get_task_version(user_key)
+    task_ids = storage.list_task_ids(user_key, limit, cursor, status)
 
-    for task_document in Task.collection.parent(user_key).fetch():
-        tasks.append(task_document.id)
+    response_etag.set(make_tasks_etag(user_key, task_version, limit, cursor, status))
 
-    return tasks
+    return task_ids
+
+@response(Node('map', fields={status: Node('number', decimal=False) for status in TASK_STATUS}))
+@adaptor(endpoint_adaptor)
+@collection_endpoint("tasks", "count", authentication=True)
+def count_tasks(user_key):
+    """ Count the tasks by status.
+
+    It returns the number of tasks for the user in each status (without
+    reading the tasks).
+    """
+
+    task_version = storage.get_task_version(user_key)
+    counts = storage.count_tasks(user_key, TASK_STATUS)
+
+    response_etag.set(make_task_counts_etag(user_key, task_version))
+
+    return counts
+
+@request(Node('map', fields={
+    'version': Node('number', decimal=False, minimum=0, option=True),
+    'timeout': Node('number', decimal=False, minimum=0, maximum=MAX_CHANGES_TIMEOUT, option=True)
+}))
+@response(Node('map', fields={
+    'version': Node('number', decimal=False),
+    'reset':   Node('flag'),
+    'changed': Node('array', value=Node('map', fields={
+        'id':          Node('string'),
+        'name':        Node('string'),
+        'description': Node('string', option=True),
+        'status':      Node('enum', values=TASK_STATUS)
+    })),
+    'deleted': Node('array', value=Node('string'))
+}))
+@adaptor(endpoint_adaptor)
+@collection_endpoint("tasks", "changes", authentication=True)
+def list_task_changes(user_key, version, timeout):
+    """ List the changes of the tasks.
+
+    It returns the tasks created or updated, and the IDs of the tasks deleted,
+    after the given version, along with the current version to pass to the
+    next call. Without version (or if it's unknown, or older than the changes
+    kept), all tasks are returned and 'reset' is true. If nothing changed, it
+    waits up to 'timeout' seconds for a change before answering.
+    """
+
+    current_version = storage.get_task_version(user_key)
+    version = check_task_version(version or 0, current_version)
+
+    if version == current_version and version > 0:
+        if timeout:
+            current_version = task_version_watches.wait(user_key, version, timeout)
+
+        if current_version == version:
+            return make_task_changes(current_version, {}, [], False)
+
+    changed_tasks, deleted_ids = storage.list_task_changes(user_key, version)
+    return make_task_changes(current_version, changed_tasks, deleted_ids, version == 0)
 
 @request(Node('enum', values=TASK_STATUS))
+@error('invalid-user-id')
 @adaptor(endpoint_adaptor)
 @collection_endpoint("tasks", "mark-all-as", authentication=True)
 def mark_all_tasks_as(user_key, status):
@@ -308,9 +956,12 @@ def mark_all_tasks_as(user_key, status):
     It changes the status of all tasks for the user.
     """
 
-    for task_document in Task.collection.parent(user_key).fetch():
-        task_document.status = status
-        task_document.save()
+    try:
+        storage.mark_all_tasks_as(user_key, status)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    task_cache.delete_prefix(user_key + '/tasks/')
 
 @response(Node('map', fields={
     'user-count':            Node('number', decimal=False),
@@ -328,44 +979,185 @@ def status():
     It returns information about the service such as the number of users, tasks, etc.
     """
 
-    user_count = 0
-    task_count = 0
-    all_task_counts = []
+    user_count, task_count = storage.read_counters()
+    response_etag.set(make_status_etag(user_count, task_count))
 
-    for user_document in User.collection.fetch():
-        print(user_document)
+    return make_status(user_count, task_count)
 
-        user_task_count = 0
-        for task_document in Task.collection.parent(user_document.key).fetch():
+cache_stats_node = Node('map', fields={
+    'size':      Node('number', decimal=False),
+    'hits':      Node('number', decimal=False),
+    'misses':    Node('number', decimal=False),
+    # Should be a decimal but it's not implemented yet; work around is to use String()
+    'hit-ratio': Node('string'),
+    'evictions': Node('number', decimal=False)
+})
 
-            user_task_count += 1
+@response(Node('map', fields={
+    'token-cache': cache_stats_node,
+    'task-cache':  cache_stats_node
+}))
+@adaptor(endpoint_adaptor)
+@endpoint("cache-stats")
+def cache_stats():
+    """ Get the statistics of the caches.
 
-        all_task_counts.append(user_task_count)
-        task_count += user_task_count
-        user_count += 1
+    It returns the number of entries, hits, misses and evictions of each cache
+    of the server process answering the request.
+    """
 
     return {
-        'user-count': user_count,
-        'task-count': task_count,
-        'average-task-per-user': str(sum(all_task_counts) / len(all_task_counts)),
-        'session-duration': SESSION_DURATION,
-        'max-task-per-user': MAX_TASK_PER_USER
+        'token-cache': make_cache_stats(token_cache),
+        'task-cache':  make_cache_stats(task_cache)
     }
 
-endpoints.add_endpoint(login)
-endpoints.add_endpoint(status)
+# Tasks are exported and imported as NDJSON streams (see ndjson.py) with plain
+# routes, as endpoints can't stream their documents. Both are authenticated
+# like the endpoints.
+@endpoints.flask.route('/tasks/export', methods=['POST'])
+def export_tasks_route():
+    user_key = authenticate(flask.request.headers.get('Authorization', ''))
+    if user_key is None:
+        return {}, 401
+
+    activity.record(user_key)
+
+    return flask.Response(export_tasks(user_key), mimetype=CONTENT_TYPE)
+
+@endpoints.flask.route('/tasks/import', methods=['POST'])
+def import_tasks_route():
+    user_key = authenticate(flask.request.headers.get('Authorization', ''))
+    if user_key is None:
+        return {}, 401
+
+    activity.record(user_key)
+
+    chunks = iter(lambda: flask.request.stream.read(IMPORT_CHUNK_SIZE), b'')
+    count, error = import_tasks(user_key, read_lines(chunks))
+
+    document = {'imported-count': count}
+    if error is not None:
+        return document | error, 400
+
+    return document, 200
+
+# Requests to the endpoints are admitted (or rejected with a 429 status code)
+# before their body is read.
+@endpoints.flask.before_request
+def admission_control():
+    if flask.request.method != 'POST' or flask.request.url_rule is None:
+        return None
+
+    ip = client_ip(flask.request.headers.get('X-Forwarded-For'), flask.request.remote_addr, TRUSTED_PROXY_COUNT)
+    headers = flask.request.headers
+    retry_after = admit_request(flask.request.path, headers.get('Authorization', ''), ip, headers.get('X-Request-Start'))
+    if retry_after is not None:
+        return '', 429, {'Retry-After': make_retry_after(retry_after)}
+
+    flask.g.admitted = True
+
+    # Requests of the change feed hold their thread while they wait.
+    name = route_name(flask.request.path)
+    if name in LONG_POLL_ENDPOINTS:
+        if not long_polls.enter():
+            requests_rejected.increment(name, 'overloaded')
+            return '', 429, {'Retry-After': make_retry_after(1.0)}
+
+        flask.g.long_poll = True
+
+@endpoints.flask.before_request
+def conditional_request():
+    response_etag.set(None)
+
+    if_none_match = flask.request.headers.get('If-None-Match')
+    if not if_none_match or flask.request.method != 'POST':
+        return None
+
+    if route_name(flask.request.path) not in CONDITIONAL_ENDPOINTS:
+        return None
+
+    user_key = authenticate(flask.request.headers.get('Authorization', ''))
+    etag = current_etag(flask.request.path, user_key, flask.request.get_json(silent=True))
+    if etag is not None and etag_matches(if_none_match, etag):
+        if user_key is not None:
+            activity.record(user_key)
+
+        return '', 304, {'ETag': etag}
+
+@endpoints.flask.after_request
+def add_etag(response):
+    etag = response_etag.get()
+    if etag is not None and response.status_code == 200:
+        # The compressed representation is not byte-identical.
+        if 'Content-Encoding' in response.headers:
+            etag = 'W/' + etag
+
+        response.headers['ETag'] = etag
+
+    return response
+
+@endpoints.flask.teardown_request
+def release_admission(exception):
+    if flask.g.pop('admitted', False):
+        release_request(flask.request.path)
+
+    if flask.g.pop('long_poll', False):
+        long_polls.leave()
+
+# The body of the requests is rewritten before the Endpoints library reads it.
+class OptionalFieldsMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        name = route_name(environ.get('PATH_INFO', ''))
+        if environ.get('REQUEST_METHOD') == 'POST' and name in OPTIONAL_FIELDS:
+            # Chunked bodies (without length) can only be read whole when the
+            # server terminates the input.
+            if environ.get('wsgi.input_terminated'):
+                body = environ['wsgi.input'].read()
+            else:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+                body = environ['wsgi.input'].read(length) if length > 0 else b''
+
+            if not body.strip():
+                environ['CONTENT_TYPE'] = 'application/json'
+
+            body = fill_optional_fields(name, body)
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+
+        return self.wsgi_app(environ, start_response)
+
+endpoints.flask.wsgi_app = OptionalFieldsMiddleware(endpoints.flask.wsgi_app)
+
+# Endpoints are instrumented (see metrics.py) as they're added.
+def add_endpoint(function):
+    if function.__name__ in COALESCED_ENDPOINTS:
+        function = coalesce_endpoint(function, COALESCE_WINDOW, (response_etag,))
+
+    endpoints.add_endpoint(instrument_endpoint(function))
+
+add_endpoint(login)
+add_endpoint(status)
+add_endpoint(cache_stats)
 
 endpoints.add_collection("users", name="User", description="Represents a user having tasks associated to it.")
-endpoints.add_endpoint(get_user)
-endpoints.add_endpoint(list_users)
+add_endpoint(get_user)
+add_endpoint(list_users)
 
 endpoints.add_collection("tasks", name="Task", description="Task represents something that you need to do.")
-endpoints.add_endpoint(create_task)
-endpoints.add_endpoint(get_task)
-endpoints.add_endpoint(update_task)
-endpoints.add_endpoint(delete_task)
-endpoints.add_endpoint(list_tasks)
-endpoints.add_endpoint(mark_all_tasks_as)
+add_endpoint(create_task)
+add_endpoint(create_many_tasks)
+add_endpoint(get_task)
+add_endpoint(get_many_tasks)
+add_endpoint(update_task)
+add_endpoint(delete_task)
+add_endpoint(delete_many_tasks)
+add_endpoint(list_tasks)
+add_endpoint(count_tasks)
+add_endpoint(list_task_changes)
+add_endpoint(mark_all_tasks_as)
 
 # Extra endpoint to toy around with different kind of errors.
 @endpoint("simulate-error")
@@ -373,16 +1165,66 @@ def simulate_error():
     # TODO; To be implemented.
     pass
 
-endpoints.add_endpoint(simulate_error)
+add_endpoint(simulate_error)
+
+# Expose the metrics (in the Prometheus text format) of the server process
+# answering the request.
+def add_metrics_endpoint(path='/metrics'):
+    @endpoints.flask.route(path, methods=['GET'])
+    def metrics():
+        return generate_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# The documents serialized by Flask (the ones of the plain routes) use the fast
+# serializer (see serializer.py).
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return serializer.dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return serializer.loads(s)
+
+# Compress the responses that are large enough, if the client accepts it;
+# streamed responses are sent as is.
+def add_compression(threshold=COMPRESSION_THRESHOLD):
+    @endpoints.flask.after_request
+    def compress_response(response):
+        if response.status_code != 200 or response.is_streamed or response.direct_passthrough:
+            return response
+
+        if 'Content-Encoding' in response.headers:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not is_compressible(response.content_type or '', response.content_length or 0, threshold):
+            return response
+
+        encoding = choose_encoding(flask.request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+
+        return response
 
 # Start the endpoints server.
 if __name__ == "__main__":
     endpoints.add_shutdown_endpoint()
     endpoints.add_expose_specs_endpoint()
+    add_metrics_endpoint()
+
+    endpoints.flask.json = FastJSONProvider(endpoints.flask)
+    add_compression()
+
     endpoints.run()
 
 # Extra code to start the server with Gunicorn
 def with_unicorn():
     endpoints.add_shutdown_endpoint()
     endpoints.add_expose_specs_endpoint()
+    add_metrics_endpoint()
+
+    endpoints.flask.json = FastJSONProvider(endpoints.flask)
+    add_compression()
+
     return endpoints.flask
@@ -0,0 +1,563 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - This is the async serving mode of the service; it serves the endpoints
+#   defined in task_tracker.py (same paths, specs and errors) from an ASGI
+#   application, so a single process can keep hundreds of requests in flight
+#   while they wait on the database.
+# - Endpoints are executed as coroutines against the async storage engines
+#   (see async_storage.py); endpoints which don't have a coroutine version are
+#   executed in a thread with their sync version.
+# - The request handling mirrors the one of the Endpoints library (which is
+#   Flask based), including the error responses.
+# - Requests of the change feed wait for the tasks to change on the event loop
+#   (see changes.py).
+#
+# To start the server (with Uvicorn):
+#
+#   uvicorn --port 8000 task_tracker_asgi:app
+#
+import asyncio
+from byteplug.document.document import document_to_object
+from byteplug.document.object import object_to_document
+from byteplug.endpoints import EndpointError
+from byteplug.endpoints.endpoint import Operate
+from byteplug.endpoints.utils import json_body_expected, body_not_json_format, json_body_specs_mismatch, no_json_body_expected
+from byteplug.endpoints.utils import invalid_response_specs_mismatch, invalid_error, invalid_error_specs_mismatch, unhandled_error
+from byteplug.endpoints.utils import valid_error
+import task_tracker
+from task_tracker import MAX_TASK_PER_USER, COALESCE_WINDOW, COALESCED_ENDPOINTS, task_cache
+from task_tracker import make_token, make_task_key, make_task_fields, filter_task_ids, make_task_items, make_status
+from task_tracker import make_new_tasks, make_deleted_items, log_login
+from task_tracker import admit_request, release_request, make_retry_after
+from task_tracker import authenticate, export_tasks, import_tasks, fill_optional_fields
+from task_tracker import CONDITIONAL_ENDPOINTS, response_etag, etag_matches
+from task_tracker import make_task_etag, make_tasks_etag, make_task_counts_etag, make_status_etag
+from task_tracker import TASK_STATUS, check_task_version, make_task_changes, activity
+from task_tracker import COMPRESSION_THRESHOLD, TRUSTED_PROXY_COUNT, OPTIONAL_FIELDS, CORS_EXPOSE_HEADERS
+from storage import UserNotFound
+from async_storage import make_async_storage
+from coalesce import coalesce_coroutine
+from changes import TaskVersionWatches
+from metrics import endpoint_name, instrument_coroutine, generate_metrics
+from ratelimit import client_ip, route_name
+from ndjson import CONTENT_TYPE, read_lines
+from compression import choose_encoding, is_compressible, compress
+from serializer import dumps, loads
+
+storage = make_async_storage(task_tracker.storage)
+task_version_watches = TaskVersionWatches(storage)
+
+async def login(username, password):
+    user, created = await storage.get_or_create_user(username, password)
+
+    valid_password = created or user['password'] == password
+    log_login(username, user['key'], created, valid_password)
+
+    if not valid_password:
+        raise EndpointError('invalid-password', None)
+
+    if not created:
+        activity.record(user['key'])
+
+    return make_token(user['key'])
+
+async def get_user(user_id):
+    user = await storage.get_user(user_id)
+
+    if user is None:
+        raise EndpointError('invalid-user-id')
+
+    return {
+        'username': user['username'],
+        'password': user['password'],
+        'last-updated': int(user['last_updated'].timestamp())
+    }
+
+async def list_users(limit, cursor):
+    return await storage.list_user_ids(limit, cursor)
+
+async def create_task(user_key, name, description, status):
+    if not status:
+        status = 'not-done'
+
+    try:
+        task_id = await storage.create_task(user_key, name, description, status, MAX_TASK_PER_USER)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    if task_id is None:
+        raise EndpointError('too-many-tasks')
+
+    return task_id
+
+async def create_many_tasks(user_key, tasks):
+    try:
+        task_ids = await storage.create_tasks(user_key, make_new_tasks(tasks), MAX_TASK_PER_USER)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    if task_ids is None:
+        raise EndpointError('too-many-tasks')
+
+    return task_ids
+
+async def read_task(user_key, task_id):
+    task_key = make_task_key(user_key, task_id)
+
+    task = task_cache.get(task_key)
+    if task is None:
+        generation = task_cache.generation
+        task = await storage.get_task(user_key, task_id)
+
+        if task is not None:
+            task_cache.set(task_key, task, generation=generation)
+
+    return task
+
+async def get_task(user_key, task_id):
+    task = await read_task(user_key, task_id)
+    if task is None:
+        raise EndpointError('invalid-task-id')
+
+    response_etag.set(make_task_etag(user_key, task))
+
+    return {
+        'name':        task['name'],
+        'description': task['description'],
+        'status':      task['status']
+    }
+
+async def get_many_tasks(user_key, task_ids):
+    found_tasks = await storage.get_tasks(user_key, filter_task_ids(task_ids))
+    return make_task_items(task_ids, found_tasks)
+
+async def update_task(user_key, task_id, name, description, status):
+    fields = make_task_fields(name, description, status)
+
+    try:
+        updated = await storage.update_task(user_key, task_id, fields)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    if not updated:
+        raise EndpointError('invalid-task-id')
+
+    task_cache.delete(make_task_key(user_key, task_id))
+
+async def delete_task(user_key, task_id):
+    try:
+        deleted = await storage.delete_task(user_key, task_id)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    task_cache.delete(make_task_key(user_key, task_id))
+
+    if not deleted:
+        raise EndpointError('invalid-task-id')
+
+async def delete_many_tasks(user_key, task_ids):
+    try:
+        deleted_ids = await storage.delete_tasks(user_key, filter_task_ids(task_ids))
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    for task_id in deleted_ids:
+        task_cache.delete(make_task_key(user_key, task_id))
+
+    return make_deleted_items(task_ids, deleted_ids)
+
+async def list_tasks(user_key, limit, cursor, status):
+    task_version = await storage.get_task_version(user_key)
+    task_ids = await storage.list_task_ids(user_key, limit, cursor, status)
+
+    response_etag.set(make_tasks_etag(user_key, task_version, limit, cursor, status))
+
+    return task_ids
+
+async def count_tasks(user_key):
+    task_version = await storage.get_task_version(user_key)
+    counts = await storage.count_tasks(user_key, TASK_STATUS)
+
+    response_etag.set(make_task_counts_etag(user_key, task_version))
+
+    return counts
+
+async def list_task_changes(user_key, version, timeout):
+    current_version = await storage.get_task_version(user_key)
+    version = check_task_version(version or 0, current_version)
+
+    if version == current_version and version > 0:
+        if timeout:
+            current_version = await task_version_watches.wait(user_key, version, timeout)
+
+        if current_version == version:
+            return make_task_changes(current_version, {}, [], False)
+
+    changed_tasks, deleted_ids = await storage.list_task_changes(user_key, version)
+    return make_task_changes(current_version, changed_tasks, deleted_ids, version == 0)
+
+async def mark_all_tasks_as(user_key, status):
+    try:
+        await storage.mark_all_tasks_as(user_key, status)
+    except UserNotFound:
+        raise EndpointError('invalid-user-id')
+
+    task_cache.delete_prefix(user_key + '/tasks/')
+
+async def status():
+    user_count, task_count = await storage.read_counters()
+    response_etag.set(make_status_etag(user_count, task_count))
+
+    return make_status(user_count, task_count)
+
+# Coroutine versions of the endpoints, mapped by the name of their sync version.
+coroutines = {
+    'login':             login,
+    'get_user':          get_user,
+    'list_users':        list_users,
+    'create_task':       create_task,
+    'create_many_tasks': create_many_tasks,
+    'get_task':          get_task,
+    'get_many_tasks':    get_many_tasks,
+    'update_task':       update_task,
+    'delete_task':       delete_task,
+    'delete_many_tasks': delete_many_tasks,
+    'list_tasks':        list_tasks,
+    'count_tasks':       count_tasks,
+    'list_task_changes': list_task_changes,
+    'mark_all_tasks_as': mark_all_tasks_as,
+    'status':            status
+}
+
+def make_route(endpoint):
+    """ Return the endpoint along with its (instrumented) coroutine, if any. """
+
+    coroutine = coroutines.get(endpoint.__name__)
+    if coroutine is not None:
+        if endpoint.__name__ in COALESCED_ENDPOINTS:
+            coroutine = coalesce_coroutine(coroutine, COALESCE_WINDOW, (response_etag,))
+
+        coroutine = instrument_coroutine(coroutine, endpoint_name(endpoint))
+
+    return endpoint, coroutine
+
+def make_routes(endpoints):
+    """ Map the (path, whether it operates on an item) tuples to routes. """
+
+    routes = {}
+
+    for endpoint in endpoints.endpoints:
+        routes[(endpoint.specs['path'], False)] = make_route(endpoint)
+
+    for name, collection in endpoints.collections.items():
+        for endpoint in collection['endpoints']:
+            path = name + '/' + endpoint.specs['path']
+            routes[(path, endpoint.specs['operate'] == Operate.ITEM)] = make_route(endpoint)
+
+    return routes
+
+routes = make_routes(task_tracker.endpoints)
+
+def find_route(path):
+    """ Return the route and the item ID (if any) of a path. """
+
+    parts = path.strip('/').split('/')
+
+    if len(parts) == 3:
+        collection, item_id, endpoint_path = parts
+        return routes.get((collection + '/' + endpoint_path, True)), item_id
+
+    return routes.get(('/'.join(parts), False)), None
+
+async def call_endpoint(route, args):
+    endpoint, coroutine = route
+    if coroutine is not None:
+        return await coroutine(*args)
+
+    return await asyncio.to_thread(endpoint, *args)
+
+async def process_request(route, item_id, headers, body):
+    """ Process a request and return a (body, status code) tuple. """
+
+    endpoint = route[0]
+    input_kwargs = {}
+
+    if endpoint.specs['authentication']:
+        parts = headers.get('authorization', '').split(' ')
+        if len(parts) != 2 or parts[0] != "Bearer":
+            return {}, 401
+
+        input_kwargs['token'] = parts[1]
+
+    if item_id is not None:
+        input_kwargs['item'] = item_id
+
+    has_body = len(body) > 0
+    is_body_json = headers.get('content-type', '').startswith('application/json')
+
+    if endpoint.specs['request']:
+        if not has_body:
+            return json_body_expected()[:2]
+
+        if not is_body_json:
+            return body_not_json_format()[:2]
+
+        errors, warnings = [], []
+        document = document_to_object(body.decode(), endpoint.specs['request'], errors=errors, warnings=warnings)
+        if len(errors) > 0:
+            return json_body_specs_mismatch(errors, warnings)[:2]
+
+        input_kwargs['document'] = document
+    elif has_body:
+        return no_json_body_expected()[:2]
+
+    try:
+        adaptor = endpoint.specs.get('adaptor')
+        if adaptor is not None:
+            args = adaptor(**input_kwargs)
+        else:
+            args = list(input_kwargs.values())
+
+        value = await call_endpoint(route, args)
+    except EndpointError as e:
+        error = endpoint.specs['errors'].get(e.tag)
+        if error is None:
+            return invalid_error()[:2]
+
+        document = None
+        if error['specs']:
+            errors, warnings = [], []
+            document = object_to_document(e.value, error['specs'], errors=errors, warnings=warnings, no_dump=True)
+            if len(errors) > 0:
+                return invalid_error_specs_mismatch(errors, warnings)[:2]
+
+        return valid_error(e.tag, document, error['name'], error['description'])[:2]
+    except Exception:
+        return unhandled_error()[:2]
+
+    if not endpoint.specs['response']:
+        return None, 204
+
+    errors, warnings = [], []
+    document = object_to_document(value, endpoint.specs['response'], errors=errors, warnings=warnings)
+    if len(errors) > 0:
+        return invalid_response_specs_mismatch(errors, warnings)[:2]
+
+    # The document is already serialized.
+    return document, 200
+
+# Same as current_etag() of task_tracker.py, with the async storage engine.
+async def current_etag(path, user_key, document):
+    name = route_name(path)
+
+    if name == 'status':
+        return make_status_etag(*await storage.read_counters())
+
+    if user_key is None:
+        return None
+
+    if name == 'tasks/get':
+        task = await read_task(user_key, path.strip('/').split('/')[1])
+        return make_task_etag(user_key, task) if task is not None else None
+
+    if name == 'tasks/list':
+        if type(document) is not dict:
+            return None
+
+        task_version = await storage.get_task_version(user_key)
+        return make_tasks_etag(user_key, task_version, document.get('limit'), document.get('cursor'), document.get('status'))
+
+    if name == 'tasks/count':
+        return make_task_counts_etag(user_key, await storage.get_task_version(user_key))
+
+    return None
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+async def send_response(send, status_code, body=b'', content_type='application/json', extra_headers=[], accept_encoding=None):
+    headers = [
+        (b'access-control-allow-origin', b'*'),
+        (b'access-control-expose-headers', ', '.join(CORS_EXPOSE_HEADERS).encode()),
+        (b'content-type', content_type.encode())
+    ] + extra_headers
+
+    # Only the responses of the callers passing the 'Accept-Encoding' header
+    # of the request are compressed (see compression.py).
+    if accept_encoding is not None and status_code == 200:
+        headers.append((b'vary', b'Accept-Encoding'))
+
+        encoding = choose_encoding(accept_encoding)
+        if encoding is not None and is_compressible(content_type, len(body), COMPRESSION_THRESHOLD):
+            body = compress(body, encoding)
+            headers.append((b'content-encoding', encoding.encode()))
+
+            # The compressed representation is not byte-identical.
+            headers = [(name, b'W/' + value if name == b'etag' else value) for name, value in headers]
+
+    await send({'type': 'http.response.start', 'status': status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+# The export and import of tasks are streamed; they're executed in threads
+# with the sync storage engine, one page (or batch) at a time.
+async def export_tasks_stream(receive, send, user_key):
+    chunks = export_tasks(user_key)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'access-control-allow-origin', b'*'),
+        (b'content-type', CONTENT_TYPE.encode())
+    ]})
+
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+
+        await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+def iterate_body(receive, loop):
+    """ Yield the chunks of the body of a request (from another thread). """
+
+    while True:
+        message = asyncio.run_coroutine_threadsafe(receive(), loop).result()
+        yield message.get('body', b'')
+
+        if not message.get('more_body', False):
+            return
+
+async def import_tasks_stream(receive, send, user_key):
+    lines = read_lines(iterate_body(receive, asyncio.get_running_loop()))
+    count, error = await asyncio.to_thread(import_tasks, user_key, lines)
+
+    document = {'imported-count': count}
+    if error is not None:
+        return await send_response(send, 400, dumps(document | error).encode())
+
+    await send_response(send, 200, dumps(document).encode())
+
+stream_routes = {
+    '/tasks/export': export_tasks_stream,
+    '/tasks/import': import_tasks_stream
+}
+
+specs_yaml = None
+
+async def app(scope, receive, send):
+    global specs_yaml
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Generate the specs once, before serving requests.
+                specs_yaml = task_tracker.endpoints.generate_specs()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Write the pending activity of users before exiting.
+                await asyncio.to_thread(activity.stop)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    headers = {name.decode().lower(): value.decode() for name, value in scope['headers']}
+
+    if scope['method'] == 'GET' and scope['path'] == '/specs':
+        if specs_yaml is None:
+            specs_yaml = task_tracker.endpoints.generate_specs()
+        return await send_response(send, 200, specs_yaml.encode(), 'text/vnd.yaml', accept_encoding=headers.get('accept-encoding', ''))
+
+    if scope['method'] == 'GET' and scope['path'] == '/metrics':
+        return await send_response(send, 200, generate_metrics().encode(), 'text/plain; version=0.0.4', accept_encoding=headers.get('accept-encoding', ''))
+
+    # Answer CORS preflight requests (like Flask-CORS does with its defaults).
+    if scope['method'] == 'OPTIONS':
+        return await send_response(send, 200, b'', 'text/plain', [
+            (b'access-control-allow-methods', b'POST'),
+            (b'access-control-allow-headers', b'Authorization, Content-Type, If-None-Match')
+        ])
+
+    route, item_id = None, None
+
+    stream_route = stream_routes.get(scope['path'])
+    if stream_route is None:
+        route, item_id = find_route(scope['path'])
+
+    if (route is None and stream_route is None) or scope['method'] != 'POST':
+        return await send_response(send, 404, b'', 'text/plain')
+
+    client = scope.get('client') or (None, None)
+    ip = client_ip(headers.get('x-forwarded-for'), client[0], TRUSTED_PROXY_COUNT)
+
+    retry_after = admit_request(scope['path'], headers.get('authorization', ''), ip, headers.get('x-request-start'))
+    if retry_after is not None:
+        return await send_response(send, 429, b'', 'text/plain', [
+            (b'retry-after', make_retry_after(retry_after).encode())
+        ])
+
+    try:
+        if stream_route is not None:
+            user_key = authenticate(headers.get('authorization', ''))
+            if user_key is None:
+                return await send_response(send, 401, b'{}')
+
+            activity.record(user_key)
+            return await stream_route(receive, send, user_key)
+
+        body = await read_body(receive)
+        response_etag.set(None)
+
+        # Same as the OptionalFieldsMiddleware of task_tracker.py.
+        name = route_name(scope['path'])
+        if name in OPTIONAL_FIELDS:
+            if not body.strip():
+                headers['content-type'] = 'application/json'
+
+            body = fill_optional_fields(name, body)
+
+        if_none_match = headers.get('if-none-match')
+        if if_none_match and route_name(scope['path']) in CONDITIONAL_ENDPOINTS:
+            try:
+                request_document = loads(body) if body else None
+            except ValueError:
+                request_document = None
+
+            user_key = authenticate(headers.get('authorization', ''))
+            etag = await current_etag(scope['path'], user_key, request_document)
+            if etag is not None and etag_matches(if_none_match, etag):
+                if user_key is not None:
+                    activity.record(user_key)
+
+                return await send_response(send, 304, b'', 'text/plain', [
+                    (b'etag', etag.encode())
+                ])
+
+        document, status_code = await process_request(route, item_id, headers, body)
+    finally:
+        release_request(scope['path'])
+
+    etag = response_etag.get()
+    extra_headers = []
+    if etag is not None and status_code == 200:
+        extra_headers.append((b'etag', etag.encode()))
+
+    accept_encoding = headers.get('accept-encoding', '')
+
+    if status_code == 204:
+        await send_response(send, 204)
+    elif isinstance(document, str):
+        await send_response(send, status_code, document.encode(), extra_headers=extra_headers, accept_encoding=accept_encoding)
+    else:
+        await send_response(send, status_code, dumps(document).encode(), extra_headers=extra_headers, accept_encoding=accept_encoding)
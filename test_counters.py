@@ -0,0 +1,244 @@
+import os
+import time
+import random
+import string
+import pytest
+import fireo
+from concurrent.futures import ThreadPoolExecutor
+from stats import STATS_SHARD_COUNT, increment_counters, sum_counters
+import storage as storage_module
+from datetime import timedelta
+from storage import MemoryStorage, UserNotFound, make_storage
+from transactions import create_tasks_writes, delete_tasks_writes
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+# Checks of the counters of users and tasks; run them with pytest. They run
+# against the memory engine (no deployment needed), and also against the
+# Firestore engine if the FIRESTORE_EMULATOR_HOST environment variable points
+# to an emulator (with a database used by nothing else).
+ENGINES = ['memory']
+if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+    ENGINES.append('firestore')
+
+USER_COUNT = 4
+THREAD_COUNT = 16
+ROUND_COUNT = 25
+MAX_TASK_COUNT = 10
+
+class Snapshot:
+    def __init__(self, values, reference=None):
+        self.values = values
+        self.exists = values is not None
+        self.reference = reference
+
+    def to_dict(self):
+        return self.values
+
+class Reference:
+    def __init__(self, path):
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    def collection(self, name):
+        return Reference(self.path + '/' + name if self.path else name)
+
+    def document(self, name):
+        return Reference(self.path + '/' + name)
+
+class Writer:
+    def __init__(self):
+        self.writes = []
+
+    def set(self, reference, fields, merge=False):
+        self.writes.append((reference.path, fields, merge))
+
+    def update(self, reference, fields):
+        self.writes.append((reference.path, fields, False))
+
+    def delete(self, reference):
+        self.writes.append((reference.path, None, False))
+
+def test_sum_counters():
+    snapshots = [
+        Snapshot({'user_count': 3, 'task_count': 10}),
+        Snapshot(None),
+        Snapshot({'task_count': -2}),
+        Snapshot({'user_count': -1})
+    ]
+
+    assert sum_counters(snapshots) == (2, 8)
+    assert sum_counters([]) == (0, 0)
+
+def test_increment_counters():
+    writer = Writer()
+    increment_counters(user_delta=1, task_delta=-3, writer=writer, client=Reference(''))
+
+    assert len(writer.writes) == 1
+
+    path, fields, merge = writer.writes[0]
+    assert path.startswith('stats/')
+    assert 0 <= int(path.split('/')[1]) < STATS_SHARD_COUNT
+    assert fields == {'user_count': fireo.Increment(1), 'task_count': fireo.Increment(-3)}
+    assert merge
+
+    # Nothing is written without a delta.
+    increment_counters(writer=writer, client=Reference(''))
+    assert len(writer.writes) == 1
+
+def test_create_tasks_writes():
+    writer = Writer()
+    user_snapshot = Snapshot({'task_count': 2}, Reference('users/alice'))
+    task = {'name': "Task", 'description': None, 'status': 'not-done'}
+
+    # Nothing is written beyond the maximum number of tasks.
+    assert create_tasks_writes(writer, Reference(''), user_snapshot, [task] * 2, 3) is None
+    assert writer.writes == []
+
+    with pytest.raises(UserNotFound):
+        create_tasks_writes(writer, Reference(''), Snapshot(None, Reference('users/bob')), [task], 3)
+    assert writer.writes == []
+
+def test_delete_tasks_writes():
+    writer = Writer()
+    delete_tasks_writes(writer, Reference(''), Reference('users/alice'), {'task1', 'task2'})
+
+    # The version is the commit time (it's not read).
+    writes = {path: fields for path, fields, merge in writer.writes if not path.startswith('stats/')}
+    assert writes == {
+        'users/alice/tasks/task1':         None,
+        'users/alice/tasks/task2':         None,
+        'users/alice/deleted_tasks/task1': {'version': SERVER_TIMESTAMP},
+        'users/alice/deleted_tasks/task2': {'version': SERVER_TIMESTAMP},
+        'users/alice':                     {'task_count': fireo.Increment(-2), 'task_version': SERVER_TIMESTAMP}
+    }
+
+    shard_writes = [fields for path, fields, merge in writer.writes if path.startswith('stats/')]
+    assert shard_writes == [{'task_count': fireo.Increment(-2)}]
+
+def check_counters(storage, user_keys):
+    """ Check the counters against the tasks of each user. """
+
+    user_count, task_count = storage.read_counters()
+    assert user_count == len(user_keys)
+
+    task_counts = [storage.get_user(user_key.split('/')[1])['task_count'] for user_key in user_keys]
+    assert task_count == sum(task_counts)
+
+    for user_key, user_task_count in zip(user_keys, task_counts):
+        counts = storage.count_tasks(user_key, ('not-done', 'in-progress', 'done'))
+        assert sum(counts.values()) == user_task_count
+
+        task_ids = storage.list_task_ids(user_key, 1000, None)
+        assert len(task_ids) == user_task_count
+
+def test_memory_counters():
+    storage = MemoryStorage()
+
+    user_keys = []
+    for username in ('alice', 'bob'):
+        user, created = storage.get_or_create_user(username, 'password1')
+        assert created
+        user_keys.append(user['key'])
+
+    alice, bob = user_keys
+    check_counters(storage, user_keys)
+
+    task_id = storage.create_task(alice, "Task", None, 'not-done', 3)
+    task_ids = storage.create_tasks(bob, [{'name': "Task", 'description': None, 'status': 'done'}] * 2, 3)
+    check_counters(storage, user_keys)
+
+    # Rejected creations change nothing.
+    assert storage.create_tasks(bob, [{'name': "Task", 'description': None, 'status': 'done'}] * 2, 3) is None
+    with pytest.raises(UserNotFound):
+        storage.create_task('users/unknown', "Task", None, 'not-done', 3)
+    check_counters(storage, user_keys)
+
+    storage.mark_all_tasks_as(bob, 'in-progress')
+    check_counters(storage, user_keys)
+
+    # Deleting a task twice decrements the counters once.
+    assert storage.delete_task(alice, task_id)
+    assert not storage.delete_task(alice, task_id)
+    assert storage.delete_tasks(bob, task_ids + task_ids) == set(task_ids)
+    assert storage.delete_tasks(bob, task_ids) == set()
+    check_counters(storage, user_keys)
+
+    assert storage.read_counters() == (2, 0)
+
+def test_memory_tombstones(monkeypatch):
+    storage = MemoryStorage()
+    user, _ = storage.get_or_create_user('alice', 'password1')
+
+    task_ids = storage.create_tasks(user['key'], [{'name': "Task", 'description': None, 'status': 'done'}] * 2, 3)
+    version = storage.get_task_version(user['key'])
+
+    storage.delete_task(user['key'], task_ids[0])
+    assert storage.list_task_changes(user['key'], version) == ({}, [task_ids[0]])
+
+    # Tombstones beyond the retention are pruned on the next change.
+    monkeypatch.setattr(storage_module, 'CHANGES_RETENTION', timedelta(milliseconds=50))
+    time.sleep(0.1)
+    storage.delete_task(user['key'], task_ids[1])
+    assert storage.list_task_changes(user['key'], version) == ({}, [task_ids[1]])
+    assert storage.get_task_version(user['key']) > version
+
+# The memory engine is given a latency so the threads interleave between
+# listing the tasks and deleting them (as they do with Firestore).
+@pytest.fixture(params=ENGINES)
+def storage(request):
+    if request.param == 'memory':
+        return make_storage('memory', latency=0.001)
+
+    return make_storage(request.param)
+
+def create_user(storage):
+    username = 'test_' + ''.join(random.choices(string.ascii_lowercase, k=10))
+    user, created = storage.get_or_create_user(username, 'password1')
+    assert created
+
+    return user['key']
+
+def run_worker(storage, user_keys, seed):
+    """ Create and delete tasks at random; the tasks deleted are picked among
+    the listed ones, so threads often delete the same tasks concurrently.
+    """
+
+    generator = random.Random(seed)
+    task = {'name': "Task", 'description': None, 'status': 'not-done'}
+
+    for _ in range(ROUND_COUNT):
+        user_key = generator.choice(user_keys)
+        action = generator.randrange(4)
+
+        if action == 0:
+            storage.create_task(user_key, "Task", None, 'not-done', MAX_TASK_COUNT)
+        elif action == 1:
+            storage.create_tasks(user_key, [task] * generator.randint(1, 3), MAX_TASK_COUNT)
+        else:
+            task_ids = storage.list_task_ids(user_key, MAX_TASK_COUNT, None)
+            if not task_ids:
+                continue
+
+            task_ids = generator.sample(task_ids, min(len(task_ids), 3))
+            if action == 2:
+                storage.delete_task(user_key, task_ids[0])
+            else:
+                storage.delete_tasks(user_key, task_ids)
+
+def test_concurrent_counters(storage):
+    user_count, task_count = storage.read_counters()
+    user_keys = [create_user(storage) for _ in range(USER_COUNT)]
+
+    with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+        list(executor.map(lambda seed: run_worker(storage, user_keys, seed), range(THREAD_COUNT)))
+
+    # The counters are compared with the tasks actually listed.
+    listed_counts = []
+    for user_key in user_keys:
+        listed_count = len(storage.list_task_ids(user_key, MAX_TASK_COUNT + 1, None))
+        assert listed_count <= MAX_TASK_COUNT
+
+        assert storage.get_user(user_key.split('/')[1])['task_count'] == listed_count
+        listed_counts.append(listed_count)
+
+    assert storage.read_counters() == (user_count + USER_COUNT, task_count + sum(listed_counts))
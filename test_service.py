@@ -169,7 +169,12 @@ print("")
 print("List all existing tasks...")
 
 url = BASE_URL + f"/tasks/list"
-response = requests.post(url, headers=headers)
+document = {
+    'limit': None,
+    'cursor': None,
+    'status': None
+}
+response = requests_post_json(url, document, headers)
 if response.status_code == 200:
     all_tasks = response.json()
     print("Task IDs are: ", all_tasks)
@@ -179,6 +184,30 @@ else:
     print_and_exit(response)
 print("")
 
+# List the tasks that are done only, and count the tasks by status.
+print("Listing the tasks that are done...")
+
+document = {
+    'limit': None,
+    'cursor': None,
+    'status': 'done'
+}
+response = requests_post_json(url, document, headers)
+if response.status_code == 200:
+    print("Task IDs are: ", response.json())
+else:
+    print("Failed to list the tasks that are done.")
+    print_and_exit(response)
+
+url = BASE_URL + "/tasks/count"
+response = requests.post(url, headers=headers)
+if response.status_code == 200:
+    print("Number of tasks by status: ", response.json())
+else:
+    print("Failed to count the tasks.")
+    print_and_exit(response)
+print("")
+
 # Delete task A, B and C.
 print("Deleting task A, task B and task C...")
 
@@ -216,7 +245,11 @@ print("")
 print("Listing all existing users...")
 
 url = BASE_URL + "/users/list"
-response = requests.post(url)
+document = {
+    'limit': None,
+    'cursor': None
+}
+response = requests_post_json(url, document)
 if response.status_code == 200:
     all_users = response.json()
     print("User IDs are: ", all_users)
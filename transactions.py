@@ -0,0 +1,136 @@
+# Copyright (c) 2022 - Byteplug Inc.
+#
+# This source file is part of the Byteplug toolkit for the Python programming
+# language which is released under the OSL-3.0 license. Please refer to the
+# LICENSE file that can be found at the root of the project directory.
+#
+# Written by Jonathan De Wachter <jonathan.dewachter@byteplug.io>, July 2022
+
+# Few notes:
+# - The transactions of the Firestore engines (the sync one in
+#   firestore_storage.py and the async one in async_storage.py) read their
+#   documents differently, but write the same; the functions here take what
+#   was read (snapshots) and add the writes to the transaction (or batch), so
+#   the logic is shared.
+# - They don't read anything and don't depend on the client being sync or
+#   async (the client is only used to make references).
+# - The task version written (on the tasks, the tombstones and the user) is
+#   the commit time; it's the same for all the writes of a commit, and it
+#   increases with each commit writing the user. So it doesn't need to be
+#   read; only the task count (on creation) and the tasks (to update only
+#   those that exist, and to delete them once) are read.
+# - The user is updated rather than set, so the commit fails (with NotFound)
+#   if it doesn't exist; the engines raise UserNotFound then.
+from datetime import datetime
+import fireo
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+from stats import increment_counters
+from storage import UserNotFound, legacy_snapshots_to_user, snapshot_to_task_count
+
+def create_user_writes(writer, client, lookup, legacy_snapshots, username, password):
+    """ Write the user of a username that has no lookup document.
+
+    A user created before the lookup documents (one of the legacy snapshots
+    found by its username) only gets its lookup document. Return the user and
+    whether it was created.
+    """
+
+    user = legacy_snapshots_to_user(legacy_snapshots)
+    if user is not None:
+        writer.set(lookup, {
+            'user_key': user['key'],
+            'password': user['password']
+        })
+        return user, False
+
+    user_reference = client.collection("users").document()
+    user_key = 'users/' + user_reference.id
+
+    writer.set(user_reference, {
+        'username':     username,
+        'password':     password,
+        'last_updated': datetime.now(),
+        'task_count':   0
+    })
+    writer.set(lookup, {
+        'user_key': user_key,
+        'password': password
+    })
+    increment_counters(user_delta=1, writer=writer, client=client)
+
+    return {'key': user_key, 'password': password}, True
+
+def create_tasks_writes(writer, client, user_snapshot, tasks, max_task_count):
+    """ Write new tasks of a user.
+
+    Return the IDs of the tasks, or None if the user would exceed the maximum
+    number of tasks (nothing is written then).
+    """
+
+    if not user_snapshot.exists:
+        raise UserNotFound(user_snapshot.reference.path)
+
+    if snapshot_to_task_count(user_snapshot) + len(tasks) > max_task_count:
+        return None
+
+    user_reference = user_snapshot.reference
+    tasks_collection = user_reference.collection("tasks")
+
+    task_ids = []
+    for task in tasks:
+        task_reference = tasks_collection.document()
+        writer.set(task_reference, {
+            'name':        task['name'],
+            'description': task['description'],
+            'status':      task['status'],
+            'version':     SERVER_TIMESTAMP
+        })
+        task_ids.append(task_reference.id)
+
+    writer.update(user_reference, {
+        'task_count':   fireo.Increment(len(tasks)),
+        'task_version': SERVER_TIMESTAMP
+    })
+    increment_counters(task_delta=len(tasks), writer=writer, client=client)
+
+    return task_ids
+
+def update_tasks_writes(writer, user_reference, references, fields):
+    """ Write the given fields of tasks (which are not read). """
+
+    for reference in references:
+        writer.update(reference, fields | {'version': SERVER_TIMESTAMP})
+
+    writer.update(user_reference, {'task_version': SERVER_TIMESTAMP})
+
+def mark_tasks_writes(writer, user_reference, task_snapshots, status):
+    """ Write the status of the tasks that still exist and are not already
+    in that status.
+    """
+
+    task_references = []
+    for snapshot in task_snapshots:
+        if snapshot.exists and snapshot.get('status') != status:
+            task_references.append(snapshot.reference)
+
+    if not task_references:
+        return
+
+    for reference in task_references:
+        writer.update(reference, {'status': status, 'version': SERVER_TIMESTAMP})
+
+    writer.update(user_reference, {'task_version': SERVER_TIMESTAMP})
+
+def delete_tasks_writes(writer, client, user_reference, deleted_ids):
+    """ Delete the tasks that exist (their IDs) and leave their tombstones. """
+
+    deleted_tasks = user_reference.collection("deleted_tasks")
+    for task_id in deleted_ids:
+        writer.delete(user_reference.collection("tasks").document(task_id))
+        writer.set(deleted_tasks.document(task_id), {'version': SERVER_TIMESTAMP})
+
+    writer.update(user_reference, {
+        'task_count':   fireo.Increment(-len(deleted_ids)),
+        'task_version': SERVER_TIMESTAMP
+    })
+    increment_counters(task_delta=-len(deleted_ids), writer=writer, client=client)